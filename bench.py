@@ -0,0 +1,147 @@
+"""
+Benchmarks on a synthetic course, results are emitted as JSON to compare across versions.
+
+    python bench.py --students 1000 --tasks 4 --kind image --output bench.json
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import os.path as osp
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Callable, Optional
+
+import fire
+
+import coursegen
+import indexer
+
+
+def git_version() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=osp.dirname(osp.abspath(__file__)), capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def measure(fn: Callable[[], None], repeat: int, items: int, setup: Optional[Callable[[], None]] = None) -> dict:
+    """
+    Run `fn` `repeat` times with its output silenced.
+    Returns:
+        timings in seconds and the throughput of the best run
+    """
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            runs.append(time.perf_counter() - start)
+    best = min(runs)
+    return {
+        "best": best,
+        "mean": sum(runs) / len(runs),
+        "runs": runs,
+        "items": items,
+        "items_per_sec": items / best if best > 0 else None,
+    }
+
+
+def run_benchmarks(root: str, repeat: int = 3, workers: int = 1, jobs: int = 1) -> dict:
+    from marker_base import mark_task
+    from marker_common import assignment_marker
+    from processor import backup, submission_check, submission_grades
+    from rebaser import rebase_deduction_on_roster
+    from stats import batch_stats
+
+    logging.getLogger("marker").setLevel(logging.WARNING)  # set by the marker on import
+    tasks = sorted(d for d in os.listdir(root) if d.startswith("task"))
+    task = tasks[0]
+    files = [f for f in os.listdir(osp.join(root, task)) if f.endswith(".pdf")]
+    results = {}
+
+    cwd = os.getcwd()
+    os.chdir(root)  # the marker resolves targets relative to the task path
+    try:
+        os.makedirs("dist", exist_ok=True)
+        src = osp.join(task, files[0])
+        results["mark_task"] = measure(lambda: mark_task(src, "95", None, osp.join("dist", "single.pdf")), repeat, 1)
+        for name, incremental in (("mark", False), ("mark_incremental", True)):
+            results[name] = measure(
+                lambda: assignment_marker(task, reason_limit=100, workers=workers, incremental=incremental, force=True),
+                repeat, len(files),
+            )
+        results["check"] = measure(
+            lambda: submission_check(task), repeat, len(files), setup=lambda: indexer.invalidate(task)
+        )
+        results["backup"] = measure(lambda: backup(task), repeat, len(files), setup=lambda: indexer.invalidate(task))
+        for t in tasks:
+            submission_grades(t)
+        results["stats_all"] = measure(lambda: batch_stats(tasks, jobs=jobs), repeat, len(tasks))
+        results["rebase"] = measure(
+            lambda: rebase_deduction_on_roster(osp.join(task, "deduction.csv"), "names.csv", "rebased.csv"),
+            repeat, 1,
+        )
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def bench(
+    root: Optional[str] = None,
+    students: int = 100,
+    tasks: int = 3,
+    pages: int = 2,
+    kind: str = "text",
+    image_size: int = 512,
+    repeat: int = 3,
+    workers: int = 1,
+    jobs: int = 1,
+    output: Optional[str] = None,
+):
+    """
+    Generate a synthetic course (see coursegen.generate) and benchmark the commands on it.
+    Args:
+        root: directory of the course, a temporary one is used if not given
+        workers: processes of the marker
+        jobs: threads of stats_all
+        output: JSON file to write the report to, printed otherwise
+    """
+    params = {
+        "students": students, "tasks": tasks, "pages": pages, "kind": kind,
+        "image_size": image_size, "repeat": repeat, "workers": workers, "jobs": jobs,
+    }
+    with tempfile.TemporaryDirectory() if root is None else contextlib.nullcontext(root) as course:
+        start = time.perf_counter()
+        coursegen.generate(course, students, tasks, pages, kind, image_size)
+        params["generate_seconds"] = time.perf_counter() - start
+        results = run_benchmarks(course, repeat, workers, jobs)
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as fd:
+            fd.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    fire.Fire(bench, name="bench")
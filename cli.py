@@ -1,26 +1,82 @@
-from bomer import with_BOM
-from grader import pre_grade
-from processor import backup, submission_grades, submission_info_by_roster, submission_check
-from rebaser import rebase_deduction_on_roster
-from stats import batch_stats, submission_stats
-from marker_common import assignment_marker
+import importlib
+import os
+import sys
+import time
 
 import fire
 
+# command: (module, function)
+# modules are imported only for the command being run, so the csv commands skip reportlab and pypdf
+COMMANDS = {
+    "bom": ("bomer", "with_BOM"),
+    "pregrade": ("grader", "pre_grade"),  # pregrade and log reasons
+    "pregrade_undo": ("grader", "undo_pre_grade"),  # revert the last pregrade
+    "backup": ("processor", "backup"),  # backup submission files after check
+    "snapshots": ("snapshot", "list_snapshots"),
+    "restore": ("snapshot", "restore_snapshot"),  # restore a task folder from a backup snapshot
+    "diff": ("processor", "submission_info_by_roster"),  # check submission diff with roster
+    "check": ("processor", "submission_check"),  # check submission status
+    "dupes": ("duper", "find_dupes"),  # identical submissions of different students
+    "grades": ("processor", "submission_grades"),
+    "signin": ("processor", "signin_info_by_roster"),  # attendance of the sign-in sessions
+    "rebase": ("rebaser", "rebase_deduction_on_roster"),
+    "stats_all": ("stats", "batch_stats"),
+    "stats_task": ("stats", "submission_stats"),
+    "export": ("gradebook", "export_gradebook"),  # export a gradebook table to csv
+
+    "mark": ("marker_common", "assignment_marker"),  # common marker
+    "mark_shared": ("marker_lease", "lease_marker"),  # one of the machines marking a shared folder
+    "mark_summary": ("marker_lease", "lease_summary"),  # merge the results of mark_shared
+}
+
+# set it to report the import time of the commands and warn once the budget is exceeded
+IMPORT_BUDGET_ENV = "MARKER_IMPORT_BUDGET_MS"
+# run the command under cProfile and report the hottest functions, stages and files
+PROFILE_FLAG = "--profile"
+PROFILE_TOP = 25
+
+
+def load_commands(argv: list[str]) -> dict:
+    """import the requested command only, or all of them for the help of the whole cli"""
+    names = argv[:1] if argv and argv[0] in COMMANDS else list(COMMANDS)
+    start = time.perf_counter()
+    commands = {}
+    for name in names:
+        module, func = COMMANDS[name]
+        commands[name] = getattr(importlib.import_module(module), func)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    budget = os.environ.get(IMPORT_BUDGET_ENV)
+    if budget:
+        print(f"import {','.join(names)}: {elapsed:.1f}ms", file=sys.stderr)
+        if elapsed > float(budget):
+            print(f"import time exceeds the budget of {budget}ms", file=sys.stderr)
+    return commands
+
+
+def profile(commands: dict, argv: list[str]):
+    """
+    Run the command under cProfile and print the report to stderr.
+    Worker processes of the marker are not profiled, but their stage timings are in the report.
+    """
+    import cProfile
+    import pstats
+
+    from logger import metrics
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(fire.Fire, commands, command=argv, name="marker")
+    finally:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+        print(metrics.summary(), file=sys.stderr)
+
+
 if __name__ == "__main__":
-    fire.Fire(
-        {
-            "bom": with_BOM,
-            "pregrade": pre_grade, # pregrade and log reasons
-            "backup": backup, # backup submission files after check
-            "diff": submission_info_by_roster,  # check submission diff with roster
-            "check": submission_check,  # check submission status
-            "grades": submission_grades,
-            "rebase": rebase_deduction_on_roster,
-            "stats_all": batch_stats,
-            "stats_task": submission_stats,
-
-            "mark": assignment_marker, # common marker
-        },
-        name="marker",
-    )
+    argv = sys.argv[1:]
+    if PROFILE_FLAG in argv:
+        argv.remove(PROFILE_FLAG)
+        profile(load_commands(argv), argv)
+    else:
+        fire.Fire(load_commands(argv), name="marker")
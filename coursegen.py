@@ -0,0 +1,120 @@
+"""
+Synthetic course generator for benchmarks.
+
+Layout of a generated course:
+- names.csv: seq,sid,name,class
+- task{1..M}/sid-name-task-score.pdf with deduction.csv
+- week{1..K}/signin/sid-name.jpg
+"""
+
+import os
+import os.path as osp
+import random
+from io import BytesIO
+
+import fire
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from header import PROVIDER_HEADER
+
+ROSTER_HEADER = "序号,学号,姓名,班级"
+DEDUCTION_HEADER = "学号,姓名,扣分情况"
+SID_BASE = 2024000000000
+
+
+def make_pdf(path: str, pages: int = 2, kind: str = "text", image_size: int = 512, seed: int = 0):
+    """
+    Args:
+        kind: "text" for text-only pages or "image" for a noise image (incompressible, like scans) on each page
+        image_size: edge of the images in pixels
+    """
+    assert kind in ("text", "image"), f"unknown pdf kind {kind}"
+    rng = random.Random(seed)
+    width, height = A4
+    c = canvas.Canvas(path, pagesize=A4)
+    for p in range(pages):
+        if kind == "image":
+            from PIL import Image  # shipped with reportlab
+
+            img = Image.frombytes("L", (image_size, image_size), rng.randbytes(image_size * image_size))
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            c.drawImage(ImageReader(buffer), 36, 36, width - 72, height - 72)
+        else:
+            for line in range(40):
+                c.drawString(50, height - 60 - line * 18, f"page {p + 1} line {line + 1} " + "lorem ipsum " * 6)
+        c.showPage()
+    c.save()
+
+
+def generate(
+    root: str,
+    students: int = 100,
+    tasks: int = 3,
+    pages: int = 2,
+    kind: str = "text",
+    image_size: int = 512,
+    submit_rate: float = 0.95,
+    deduct_rate: float = 0.3,
+    sessions: int = 0,
+    seed: int = 0,
+):
+    """
+    Generate a synthetic course under `root`.
+    Args:
+        students: number of students in names.csv
+        tasks: number of task folders
+        pages, kind, image_size: shape of the submitted pdfs, see `make_pdf`
+        submit_rate: chance of a student submitting a task
+        deduct_rate: chance of a submission with deductions
+        sessions: number of sign-in sessions
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    roster = [(str(SID_BASE + i), f"student{i:04d}") for i in range(students)]
+    with open(osp.join(root, "names.csv"), "w", encoding="utf-8-sig") as fd:
+        fd.write(ROSTER_HEADER + "\n")
+        fd.writelines(f"{i + 1},{sid},{name},class{i % 4 + 1}\n" for i, (sid, name) in enumerate(roster))
+
+    template = osp.join(root, "template.pdf")
+    make_pdf(template, pages, kind, image_size, seed)
+    with open(template, "rb") as fd:
+        pdf = fd.read()
+    os.remove(template)
+
+    for t in range(1, tasks + 1):
+        task = osp.join(root, f"task{t}")
+        os.makedirs(task, exist_ok=True)
+        deductions = []
+        for sid, name in roster:
+            if rng.random() >= submit_rate:
+                continue
+            score = 100
+            if rng.random() < deduct_rate:
+                late, wrong = rng.randint(0, 3), rng.randint(1, 20)
+                score -= late + wrong
+                deductions.append(f"{sid},{name},迟交(-{late})，答案错误(-{wrong})\n")
+            with open(osp.join(task, f"{sid}-{name}-{t}-{score}.pdf"), "wb") as fd:
+                fd.write(pdf)
+                fd.write(f"%{sid}\n".encode())  # unique bytes for each submission
+        with open(osp.join(task, "deduction.csv"), "w", encoding="utf-8-sig") as fd:
+            fd.write(DEDUCTION_HEADER + "\n")
+            fd.writelines(deductions)
+
+    for s in range(1, sessions + 1):
+        signin = osp.join(root, f"week{s}", "signin")
+        os.makedirs(signin, exist_ok=True)
+        for sid, name in roster:
+            if rng.random() < submit_rate:
+                open(osp.join(signin, f"{sid}-{name}.jpg"), "wb").close()
+
+    # roster in the sid,name layout
+    with open(osp.join(root, "provider.csv"), "w", encoding="utf-8-sig") as fd:
+        fd.write(PROVIDER_HEADER + "\n")
+        fd.writelines(f"{sid},{name}\n" for sid, name in roster)
+
+
+if __name__ == "__main__":
+    fire.Fire(generate, name="coursegen")
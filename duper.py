@@ -0,0 +1,126 @@
+"""
+Duplicate submissions across students.
+
+Every submission of the task folders is hashed (chunked reads in a thread pool) and
+submissions with the same content but different SIDs are reported. Hashes are cached in
+a hidden file of each task folder by (file name, size, mtime), so reruns only hash new files.
+
+With `pages`, pdfs are also fingerprinted page by page (normalized text, or the image data of
+scanned pages), which catches a copy re-saved by another tool.
+"""
+
+import hashlib
+import json
+import os
+import os.path as osp
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import fire
+
+from indexer import Submission, get_index
+from marker_manifest import file_digest
+
+HASH_CACHE = ".hashes.json"  # hidden, so it is not indexed as a submission
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def page_fingerprints(pdf: str) -> list[str]:
+    """hash of the normalized text of each page, of its image data if it has no text"""
+    from pypdf import PdfReader  # only fingerprints need pypdf
+
+    prints = []
+    for page in PdfReader(pdf).pages:
+        sha = hashlib.sha1()
+        text = WHITESPACE_RE.sub(" ", page.extract_text() or "").strip().lower()
+        if text:
+            sha.update(text.encode())
+        else:
+            xobjects = page.get("/Resources", {}).get("/XObject", {})
+            for name in sorted(xobjects):
+                xobj = xobjects[name].get_object()
+                if xobj.get("/Subtype") == "/Image":
+                    sha.update(xobj.get_data())
+        prints.append(sha.hexdigest())
+    return prints
+
+
+def load_hash_cache(path: str) -> dict[str, dict]:
+    cache = osp.join(path, HASH_CACHE)
+    if not osp.exists(cache):
+        return {}
+    try:
+        with open(cache, encoding="utf-8") as fd:
+            return json.load(fd)
+    except json.JSONDecodeError:
+        return {}  # rebuilt below
+
+
+def save_hash_cache(path: str, entries: dict[str, dict]):
+    cache = osp.join(path, HASH_CACHE)
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fd:
+        json.dump(entries, fd, ensure_ascii=False)
+    os.replace(tmp, cache)
+
+
+def hash_submission(path: str, sub: Submission, cached: Optional[dict], pages: bool) -> dict:
+    """cached entry of `sub` if it is still valid, otherwise a new one"""
+    file = osp.join(path, sub.filename)
+    st = os.stat(file)
+    entry = cached if cached and (cached["size"], cached["mtime_ns"]) == (st.st_size, st.st_mtime_ns) else None
+    if entry is None:
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": file_digest(file)}
+    if pages and "pages" not in entry and sub.ext.lower() == "pdf":
+        try:
+            entry["pages"] = page_fingerprints(file)
+        except Exception as e:  # broken pdfs are still compared by their hash
+            print(f"{file} can not be fingerprinted: {type(e).__name__}: {e}")
+            entry["pages"] = []
+    return entry
+
+
+def hash_task(path: str, pages: bool = False, jobs: int = 4) -> list[tuple[Submission, dict]]:
+    cache = load_hash_cache(path)
+    subs = list(get_index(path))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        entries = list(pool.map(lambda sub: hash_submission(path, sub, cache.get(sub.filename), pages), subs))
+    # entries of removed files are dropped
+    save_hash_cache(path, {sub.filename: entry for sub, entry in zip(subs, entries)})
+    return list(zip(subs, entries))
+
+
+def find_dupes(paths: str | list[str], pages: bool = False, jobs: int = 4):
+    """
+    Report groups of identical submissions of different students across the task folders.
+    Args:
+        paths: task folders
+        pages: also compare the page fingerprints of pdfs, slower on the first run
+        jobs: number of threads to hash files with
+    """
+    paths = [paths] if isinstance(paths, str) else paths
+    groups = defaultdict(list)  # (kind, digest): [(file, sid)]
+    for path in paths:
+        for sub, entry in hash_task(path, pages, jobs):
+            file = osp.join(path, sub.filename)
+            groups[("file", entry["sha256"])].append((file, sub.sid))
+            if pages and entry.get("pages"):
+                digest = hashlib.sha1("".join(entry["pages"]).encode()).hexdigest()
+                groups[("pages", digest)].append((file, sub.sid))
+
+    seen, count = set(), 0
+    for (kind, _), members in groups.items():
+        files = frozenset(file for file, _ in members)
+        if len({sid for _, sid in members}) < 2 or files in seen:
+            continue  # the same student, or reported as identical files already
+        seen.add(files)
+        count += 1
+        label = "identical files" if kind == "file" else "identical pages"
+        print(f"{label}: " + ", ".join(f"{file} ({sid})" for file, sid in sorted(members)))
+    print(f"Total {count} groups of duplicates found")
+
+
+if __name__ == "__main__":
+    fire.Fire(find_dupes, name="duper")
@@ -0,0 +1,152 @@
+"""
+Optional SQLite gradebook mirroring the generated csv files.
+
+Commands given `--db gradebook.db` also write their records into it (one transaction per task,
+replacing the previous records of the task, or merged into them by rebase), so cross-task
+queries are index lookups.
+The tables are exported to the same UTF-8-BOM csv files for Excel by `export_gradebook`.
+"""
+
+import csv
+import os.path as osp
+import sqlite3
+from typing import Iterable, Optional
+
+import fire
+
+from header import PREGRADE_HEADER, PROVIDER_HEADER, SCORE_HEADER, SUBMIT_HEADER
+from roster import Roster
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roster (
+    sid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    seq INTEGER
+);
+CREATE TABLE IF NOT EXISTS submissions (
+    task TEXT NOT NULL,
+    sid TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (task, sid, filename)
+);
+CREATE TABLE IF NOT EXISTS deductions (
+    task TEXT NOT NULL,
+    sid TEXT NOT NULL,
+    name TEXT,
+    reason TEXT NOT NULL,
+    delta INTEGER,
+    PRIMARY KEY (task, sid)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    task TEXT NOT NULL,
+    sid TEXT NOT NULL,
+    name TEXT,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (task, sid)
+);
+CREATE INDEX IF NOT EXISTS submissions_sid ON submissions (sid);
+CREATE INDEX IF NOT EXISTS deductions_sid ON deductions (sid);
+CREATE INDEX IF NOT EXISTS scores_sid ON scores (sid);
+"""
+
+# table: (header of the csv file, columns without the task)
+TABLES = {
+    "roster": (PROVIDER_HEADER, ("sid", "name")),
+    "submissions": (SUBMIT_HEADER, ("sid", "ext", "filename")),
+    "deductions": (PREGRADE_HEADER, ("sid", "name", "reason", "delta")),
+    "scores": (SCORE_HEADER, ("sid", "name", "score")),
+}
+
+
+def task_name(path: str) -> str:
+    """tasks are keyed by the name of their directory"""
+    return osp.basename(osp.abspath(path))
+
+
+class Gradebook:
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def put_roster(self, roster: Roster):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO roster (sid, name, seq) VALUES (?, ?, ?)",
+                (
+                    (sid, name, seq if seq >= 0 else None)
+                    for sid, name, seq in zip(roster.sids, roster.names, roster.seqs)
+                ),
+            )
+
+    def put_task(self, table: str, task: str, rows: Iterable[tuple]):
+        """replace the records of `task` in `table` by `rows` of the columns in TABLES"""
+        columns = TABLES[table][1]
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {table} WHERE task = ?", (task,))
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {table} (task, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})",
+                ((task, *row) for row in rows),
+            )
+
+    def merge_task(self, table: str, task: str, rows: Iterable[tuple]):
+        """
+        Insert or update `rows` of `task` in `table` (deductions or scores) by SID, other records
+        of the task are kept and None values keep the recorded ones (e.g. the deltas of pregrade).
+        """
+        assert table in ("deductions", "scores"), f"{table} is not keyed by task and SID"
+        columns = TABLES[table][1]
+        updates = ", ".join(f"{col} = COALESCE(excluded.{col}, {col})" for col in columns if col != "sid")
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {table} (task, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+                f"ON CONFLICT (task, sid) DO UPDATE SET {updates}",
+                ((task, *row) for row in rows),
+            )
+
+    def tasks(self, table: str = "scores") -> list[str]:
+        return [task for (task,) in self.conn.execute(f"SELECT DISTINCT task FROM {table} ORDER BY task")]
+
+    def scores(self, task: str) -> dict[str, int]:
+        """sid: score of `task`"""
+        return dict(self.conn.execute("SELECT sid, score FROM scores WHERE task = ?", (task,)))
+
+    def rows(self, table: str, task: Optional[str] = None) -> list[tuple]:
+        columns = ", ".join(TABLES[table][1])
+        if table == "roster":
+            return self.conn.execute(f"SELECT {columns} FROM roster ORDER BY seq, sid").fetchall()
+        return self.conn.execute(
+            f"SELECT {columns} FROM {table} WHERE task = ? ORDER BY sid", (task,)
+        ).fetchall()
+
+
+def export_gradebook(db: str, table: str, output: str, task: Optional[str] = None):
+    """
+    Export a table of the gradebook to a UTF-8-BOM csv file.
+    Args:
+        table: one of roster, submissions, deductions and scores
+        task: name of the task directory, required except for the roster
+    """
+    assert table in TABLES, f"unknown table {table}, expected one of {list(TABLES)}"
+    assert table == "roster" or task is not None, f"task of the {table} is required"
+    with Gradebook(db) as gb:
+        rows = gb.rows(table, task)
+    with open(output, "w", encoding="utf-8-sig", newline="") as fd:
+        fd.write(TABLES[table][0] + "\n")
+        csv.writer(fd, lineterminator="\n").writerows(rows)
+    print(f"{len(rows)} rows of {table} exported to {output}")
+
+
+if __name__ == "__main__":
+    fire.Fire(export_gradebook, name="gradebook")
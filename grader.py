@@ -1,46 +1,261 @@
+"""
+Pre-grader of ungraded submissions (sid-name-task.ext).
+
+The grading policy is a list of rules, `DEFAULT_RULES` or a JSON file of the same shape.
+The directory is scanned once into a plan of renames (sid-name-task-score.ext) and deductions,
+which is printed in a dry run or applied as one batch:
+the renames are journaled first and rolled back if any of them fails,
+and the journal is kept so the last batch can be undone by `undo_pre_grade`.
+"""
+
+import csv
+import json
+import math
 import os
 import os.path as osp
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Optional
 
 import fire
 
 from header import PREGRADE_HEADER
+from indexer import Submission, get_index, invalidate
 
+JOURNAL = ".pregrade.journal"  # hidden, so it is not indexed as a submission
+DONE = {"done": True}  # last line of the journal of a completed batch
 
-def pre_grade(path: str, grade: int = 100, output="deduction.csv"):
-    # TODO: define it yourself
-    allow_ext = ["pdf", "zip"]
-    sub_seq = [str(i) for i in range(1, 7)]
-    header = PREGRADE_HEADER
+# the policy of the course, see RULE_CHECKS for the rule types
+DEFAULT_RULES = [
+    {"type": "extension", "allow": ["pdf", "zip"], "deduct": 3, "reason": "文件格式不符合要求"},
+    {"type": "naming", "tasks": [str(i) for i in range(1, 7)], "deduct": 2, "reason": "文件命名不符合要求"},
+]
+# other rule types, e.g.
+#   {"type": "size", "max_mb": 50, "deduct": 1, "reason": "文件过大"}
+#   {"type": "late", "deadline": "2024-10-01T23:59", "deduct": 2, "per_day": true, "max": 10, "reason": "迟交"}
 
-    deduct = open(osp.join(path, output), "w", encoding="utf-8-sig")
-    deduct.write(header + "\n")
-    for file in os.listdir(path):
-        delta = 0
-        if file.endswith("csv") or osp.isdir(osp.join(path, file)):
-            continue
-        name, ext = file.split(".", 1)
-        parts = name.split("-")
-        lp = len(parts)
-        if lp == 4:
+
+def check_extension(rule: dict, sub: Submission, stat: Optional[os.stat_result]) -> int:
+    return 0 if sub.ext.lower() in rule["allow"] else rule["deduct"]
+
+
+def check_naming(rule: dict, sub: Submission, stat: Optional[os.stat_result]) -> int:
+    return 0 if sub.fields[-1] in rule["tasks"] else rule["deduct"]
+
+
+def check_size(rule: dict, sub: Submission, stat: Optional[os.stat_result]) -> int:
+    return rule["deduct"] if stat.st_size > rule["max_mb"] * (1 << 20) else 0
+
+
+def check_late(rule: dict, sub: Submission, stat: Optional[os.stat_result]) -> int:
+    """late by the modification time, `per_day` deducts for every started day, capped by `max`"""
+    late = stat.st_mtime - datetime.fromisoformat(rule["deadline"]).timestamp()
+    if late <= 0:
+        return 0
+    delta = rule["deduct"] * math.ceil(late / 86400) if rule.get("per_day") else rule["deduct"]
+    return min(delta, rule.get("max", delta))
+
+
+# rule type: (check, keys required in the rule, whether the check needs the file stat)
+RULE_CHECKS: dict[str, tuple[Callable, tuple[str, ...], bool]] = {
+    "extension": (check_extension, ("allow",), False),
+    "naming": (check_naming, ("tasks",), False),
+    "size": (check_size, ("max_mb",), True),
+    "late": (check_late, ("deadline",), True),
+}
+
+
+def load_rules(config: Optional[str] = None) -> list[dict]:
+    """
+    Args:
+        config: JSON file of a list of rules, DEFAULT_RULES if None
+    Raises:
+        ValueError: unknown rule type or missing keys
+    """
+    if config is None:
+        return DEFAULT_RULES
+    with open(config, encoding="utf-8") as fd:
+        rules = json.load(fd)
+    for rule in rules:
+        if rule.get("type") not in RULE_CHECKS:
+            raise ValueError(f"unknown rule type {rule.get('type')}, expected one of {list(RULE_CHECKS)}")
+        missing = [key for key in ("deduct", "reason", *RULE_CHECKS[rule["type"]][1]) if key not in rule]
+        if missing:
+            raise ValueError(f"rule {rule} misses {missing}")
+        if rule["type"] == "extension":
+            rule["allow"] = [ext.lower() for ext in rule["allow"]]
+        elif rule["type"] == "naming":
+            rule["tasks"] = [str(task) for task in rule["tasks"]]
+    return rules
+
+
+@dataclass
+class Grading:
+    sub: Submission
+    target: str  # file name after renaming
+    delta: int = 0
+    reasons: list[str] = field(default_factory=list)
+
+
+def make_plan(path: str, rules: list[dict], grade: int = 100) -> tuple[list[Grading], list[str]]:
+    """
+    Evaluate the rules over one scan of `path`.
+    Returns:
+        gradings of the ungraded submissions
+        files to be processed manually
+    Raises:
+        FileExistsError: renaming would overwrite a file
+    """
+    need_stat = any(RULE_CHECKS[rule["type"]][2] for rule in rules)
+    index = get_index(path)
+    plan, manual = [], []
+    for sub in index:
+        if len(sub.fields) == 4:  # graded
             continue
-        elif lp != 3:
-            print(f"{file} need to process manually")
+        if len(sub.fields) != 3:
+            manual.append(sub.filename)
             continue
+        stat = os.stat(osp.join(path, sub.filename)) if need_stat else None
+        grading = Grading(sub, "")
+        for rule in rules:
+            delta = RULE_CHECKS[rule["type"]][0](rule, sub, stat)
+            if delta:
+                grading.delta += delta
+                grading.reasons.append(f"{rule['reason']}(-{delta})")
+        grading.target = f"{sub.stem}-{grade - grading.delta}.{sub.ext}"
+        plan.append(grading)
+
+    existing = {sub.filename for sub in index}
+    targets = Counter(g.target for g in plan)
+    clashes = sorted(t for t, n in targets.items() if t in existing or n > 1)
+    if clashes:
+        raise FileExistsError(f"renaming would overwrite {clashes}")
+    return plan, manual
+
+
+def write_deductions(output: str, plan: list[Grading]):
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8-sig", newline="") as fd:
+        fd.write(PREGRADE_HEADER + "\n")
+        csv.writer(fd, lineterminator="\n").writerows(
+            (g.sub.fields[0], g.sub.fields[1], "，".join(g.reasons), g.delta) for g in plan if g.reasons
+        )
+    os.replace(tmp, output)
+
+
+def _rename_all(path: str, renames: list[tuple[str, str]]):
+    """rename all or none of `renames`"""
+    done = []
+    try:
+        for src, dst in renames:
+            os.rename(osp.join(path, src), osp.join(path, dst))
+            done.append((src, dst))
+    except OSError:
+        for src, dst in reversed(done):
+            os.rename(osp.join(path, dst), osp.join(path, src))
+        raise
+
+
+def read_journal(journal: str) -> tuple[dict, list[list[str]], bool]:
+    """
+    Returns:
+        the deduction file to restore, the renames and whether the batch completed
+    """
+    with open(journal, encoding="utf-8") as fd:
+        head = json.loads(fd.readline())
+        lines = [json.loads(line) for line in fd if line.strip()]
+    done = bool(lines) and lines[-1] == DONE
+    return head, lines[:-1] if done else lines, done
+
+
+def pre_grade(
+    path: str,
+    grade: int = 100,
+    output="deduction.csv",
+    rules: Optional[str] = None,
+    dry_run: bool = False,
+    db: Optional[str] = None,
+):
+    """
+    Args:
+        grade: full score
+        rules: JSON file of the rules, the DEFAULT_RULES of grader.py if not given
+        dry_run: print the plan without renaming files or writing `output`
+        db: SQLite gradebook to write the deductions of the task into
+    """
+    plan, manual = make_plan(path, load_rules(rules), grade)
+    for filename in manual:
+        print(f"{filename} need to process manually")
+    if dry_run:
+        for g in plan:
+            print(f"{g.sub.filename} -> {g.target} {'，'.join(g.reasons)}")
+        print(f"{len(plan)} files to be graded, {sum(1 for g in plan if g.reasons)} with deductions")
+        return
+
+    journal = osp.join(path, JOURNAL)
+    if osp.exists(journal) and not read_journal(journal)[2]:
+        raise FileExistsError(f"{journal} of an interrupted pre-grade exists, undo it first")
+    deduction = osp.join(path, output)
+    previous = None
+    if osp.exists(deduction):
+        with open(deduction, encoding="utf-8-sig") as fd:
+            previous = fd.read()
+    head = {"output": output, "previous": previous}
+    if db is not None:
+        from gradebook import Gradebook, task_name
+
+        # the deductions of the task in the gradebook are restored by undo as well
+        with Gradebook(db) as gb:
+            head.update(db=osp.abspath(db), db_previous=gb.rows("deductions", task_name(path)))
+    renames = [(g.sub.filename, g.target) for g in plan]
+    with open(journal, "w", encoding="utf-8") as fd:
+        fd.write(json.dumps(head, ensure_ascii=False) + "\n")
+        fd.writelines(json.dumps([src, dst], ensure_ascii=False) + "\n" for src, dst in renames)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    try:
+        _rename_all(path, renames)
+        write_deductions(deduction, plan)
+        with open(journal, "a", encoding="utf-8") as fd:
+            fd.write(json.dumps(DONE) + "\n")
+    except Exception:
+        _rename_all(path, [(dst, src) for src, dst in renames if osp.exists(osp.join(path, dst))])
+        os.remove(journal)
+        raise
+    finally:
+        invalidate(path)
+    if db is not None:
+        with Gradebook(db) as gb:
+            gb.put_task(
+                "deductions", task_name(path),
+                [(g.sub.fields[0], g.sub.fields[1], "，".join(g.reasons), g.delta) for g in plan if g.reasons],
+            )
+    print(f"{len(plan)} files graded, undo with `pregrade_undo {path}`")
+
+
+def undo_pre_grade(path: str):
+    """revert the renames, the deduction file and the gradebook deductions of the last pre-grade in `path`"""
+    journal = osp.join(path, JOURNAL)
+    head, renames, _ = read_journal(journal)
+    # a crashed batch is partially renamed, only the applied renames are reverted
+    _rename_all(path, [(dst, src) for src, dst in reversed(renames) if osp.exists(osp.join(path, dst))])
+    deduction = osp.join(path, head["output"])
+    if head["previous"] is None:
+        if osp.exists(deduction):
+            os.remove(deduction)
+    else:
+        with open(deduction, "w", encoding="utf-8-sig") as fd:
+            fd.write(head["previous"])
+    if head.get("db") is not None:
+        from gradebook import Gradebook, task_name
 
-        records = []
-        FORMAT_ERROR = 3
-        NAME_ERROR = 2
-
-        if ext.lower() not in allow_ext:
-            delta += FORMAT_ERROR  # match format
-            records.append(f"文件格式不符合要求(-{FORMAT_ERROR})")
-        if len(parts[-1]) != 1 or parts[-1][0] not in sub_seq:
-            delta += NAME_ERROR  # match submission name
-            records.append(f"文件命名不符合要求(-{NAME_ERROR})")
-        os.rename(osp.join(path, file), osp.join(path, f"{name}-{grade-delta}.{ext}"))
-        if records:
-            deduct.write(f"{parts[0]},{parts[1]},{'，'.join(records)},{delta}\n")
-    deduct.close()
+        with Gradebook(head["db"]) as gb:
+            gb.put_task("deductions", task_name(path), head["db_previous"])
+    os.remove(journal)
+    invalidate(path)
+    print(f"{len(renames)} renames reverted in {path}")
 
 
 if __name__ == "__main__":
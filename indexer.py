@@ -0,0 +1,94 @@
+"""
+Submission index of a task directory.
+
+The directory is listed once with `os.scandir` and every file name is parsed once into a
+`Submission` record (sid-name-task[-score].ext). Indexes are cached per directory and
+rebuilt when the modification time of the directory changes.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+SID_PATTERN = r"20\d{11}"  # 4+5+4
+FIELD_SEP = "-"
+
+
+@dataclass(frozen=True, slots=True)
+class Submission:
+    filename: str
+    stem: str
+    ext: str
+    sid: Optional[str]  # located anywhere in the file name by the SID pattern
+    fields: tuple[str, ...]  # separated fields of the stem
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.fields[1] if len(self.fields) > 1 else None
+
+    @property
+    def task(self) -> Optional[str]:
+        return self.fields[2] if len(self.fields) > 2 else None
+
+    @property
+    def score(self) -> Optional[str]:
+        """only available for graded (4 fields) submissions"""
+        return self.fields[3] if len(self.fields) == 4 else None
+
+
+class SubmissionIndex:
+    def __init__(self, path: str, sid_pattern: str = SID_PATTERN, sep: str = FIELD_SEP):
+        """
+        Scan `path` once, csv files, hidden files and directories are not submissions.
+        Args:
+            sid_pattern: regular expression of the SID
+            sep: separator of the fields in file names
+        """
+        self.path = path
+        self.sid_re = re.compile(sid_pattern)
+        self.sep = sep
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        records = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.endswith("csv") or entry.name.startswith(".") or entry.is_dir():
+                    continue
+                records.append(self.parse(entry.name))
+        self.records: list[Submission] = sorted(records, key=lambda r: r.filename)
+
+    def parse(self, filename: str) -> Submission:
+        stem, _, ext = filename.partition(".")
+        found = self.sid_re.search(filename)
+        return Submission(
+            filename, stem, ext, found.group() if found else None, tuple(stem.split(self.sep))
+        )
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def sids(self) -> list[str]:
+        """SIDs found in the directory, sorted by integer value"""
+        return sorted((r.sid for r in self.records if r.sid is not None), key=int)
+
+
+_indexes: dict[tuple[str, str, str], SubmissionIndex] = {}
+
+
+def get_index(path: str, sid_pattern: str = SID_PATTERN, sep: str = FIELD_SEP) -> SubmissionIndex:
+    """cached index of `path`, it is rebuilt once the directory is modified"""
+    key = (os.path.abspath(path), sid_pattern, sep)
+    index = _indexes.get(key)
+    if index is None or index.mtime_ns != os.stat(path).st_mtime_ns:
+        index = _indexes[key] = SubmissionIndex(path, sid_pattern, sep)
+    return index
+
+
+def invalidate(path: str):
+    """drop the cached indexes of `path`, e.g. after renaming files within the mtime granularity"""
+    path = os.path.abspath(path)
+    for key in [k for k in _indexes if k[0] == path]:
+        del _indexes[key]
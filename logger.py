@@ -1,7 +1,15 @@
+import json
 import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Optional, TextIO
+
 
 def get_default_logger(name="marker"):
     logger = logging.getLogger(name)
+    if logger.handlers:  # configured by an earlier call
+        return logger
     logger.setLevel(logging.INFO)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
@@ -10,3 +18,123 @@ def get_default_logger(name="marker"):
     logger.addHandler(console_handler)
 
     return logger
+
+
+class Metrics:
+    """
+    Stage timers and counters of a run and of each file in it.
+
+    Stages and counters go to the file being tracked (see `track_file`) and reach the run totals
+    once the file record is added, so records returned by worker processes are merged the same way.
+    Records are also written as JSON lines to `sink` if it is set.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, sink: Optional[str] = None):
+        self.stages: dict[str, float] = defaultdict(float)  # stage: seconds
+        self.calls: Counter = Counter()  # stage: times entered
+        self.counters: Counter = Counter()
+        self.files: list[dict] = []
+        self.started = time.perf_counter()
+        self._current: Optional[dict] = None
+        self.close()
+        self.sink: Optional[TextIO] = open(sink, "a", encoding="utf-8") if sink else None
+
+    def close(self):
+        sink = getattr(self, "sink", None)
+        if sink is not None:
+            sink.close()
+            self.sink = None
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if self._current is None:
+                self.stages[name] += elapsed
+                self.calls[name] += 1
+            else:
+                stages = self._current["stages"]
+                stages[name] = stages.get(name, 0.0) + elapsed
+
+    def count(self, name: str, n: int = 1):
+        if self._current is None:
+            self.counters[name] += n
+        else:
+            counters = self._current["counters"]
+            counters[name] = counters.get(name, 0) + n
+
+    @contextmanager
+    def track_file(self, name: str):
+        """
+        Collect stages and counters of `name` into the yielded record, which is picklable.
+        The record is not added to the run, pass it to `add_file` in the collecting process.
+        """
+        record = {"file": name, "seconds": 0.0, "stages": {}, "counters": {}}
+        outer, self._current = self._current, record
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self._current = outer
+
+    def add_file(self, record: dict):
+        self.files.append(record)
+        for name, seconds in record["stages"].items():
+            self.stages[name] += seconds
+            self.calls[name] += 1
+        self.counters.update(record["counters"])
+        self._emit({"type": "file", **record})
+
+    def finish(self, **info) -> dict:
+        """write the run totals to the sink and close it"""
+        run = {
+            "type": "run",
+            "seconds": time.perf_counter() - self.started,
+            "files": len(self.files),
+            "stages": dict(self.stages),
+            "counters": dict(self.counters),
+            **info,
+        }
+        self._emit(run)
+        self.close()
+        return run
+
+    def _emit(self, record: dict):
+        if self.sink is not None:
+            self.sink.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def summary(self, top: int = 10, seconds: Optional[float] = None) -> str:
+        """
+        stages by total time and the slowest files
+        Args:
+            seconds: duration of the run, the time since the reset by default
+        """
+        seconds = time.perf_counter() - self.started if seconds is None else seconds
+        lines = [f"{len(self.files)} files in {seconds:.3f}s"]
+        if self.stages:
+            lines.append(f"{'stage':<16}{'total(s)':>10}{'calls':>8}{'mean(ms)':>10}")
+            for name, total in sorted(self.stages.items(), key=lambda kv: -kv[1]):
+                calls = self.calls[name]
+                lines.append(f"{name:<16}{total:>10.3f}{calls:>8}{total / calls * 1000:>10.2f}")
+        if self.counters:
+            lines.append(", ".join(f"{name}={n}" for name, n in sorted(self.counters.items())))
+        slowest = sorted(self.files, key=lambda r: -r["seconds"])[:top]
+        if slowest:
+            lines.append(f"slowest {len(slowest)} files:")
+            for record in slowest:
+                stages = ", ".join(
+                    f"{name} {seconds:.3f}s" for name, seconds in sorted(record["stages"].items(), key=lambda kv: -kv[1])
+                )
+                lines.append(f"{record['seconds']:>8.3f}s {record['file']} ({stages})")
+        return "\n".join(lines)
+
+
+# metrics of the current process, the marker resets it for each run
+metrics = Metrics()
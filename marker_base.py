@@ -1,5 +1,8 @@
-from typing import Callable, Optional
+from typing import BinaryIO, Callable, Optional
 from dataclasses import dataclass
+from contextlib import nullcontext
+from functools import lru_cache
+from io import BytesIO
 import sys
 import os.path as osp
 import math
@@ -9,14 +12,49 @@ from reportlab.pdfgen import canvas
 from reportlab.lib import colors
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfReader, PdfWriter, PageObject
+
+from logger import metrics
+from marker_cache import OverlayCache, overlay_key
+from marker_incremental import append_overlays
+from marker_layout import LAYOUT_VERSION, get_metrics, layout_text
 
 # region font preset
 # You can download the font from https://github.com/notofonts/noto-cjk
 LocalSCFontPath = "assets/NotoSerifSC-VF.ttf"
 AbsSCFontPath = osp.join(osp.dirname(sys.argv[0]), LocalSCFontPath)
 SCFontName = "NotoSC"
-pdfmetrics.registerFont(TTFont(SCFontName, AbsSCFontPath))
+
+
+SCFontSource = AbsSCFontPath  # font file registered as SCFontName, e.g. a subset for the run
+
+
+def set_sc_font_source(path: Optional[str] = None):
+    """
+    Register `path` (a subset of the SC font, see marker_font) as the SC font of this process.
+    Args:
+        path: None for the full font
+    """
+    global SCFontSource
+    path = path or AbsSCFontPath
+    if path != SCFontSource:
+        SCFontSource = path
+        register_sc_font.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def register_sc_font() -> str:
+    """
+    Register the SC font on first use, parsing it is slow and only reasons need it.
+    Returns:
+        the registered font name
+    """
+    if not osp.exists(SCFontSource):
+        raise FileNotFoundError(
+            f"SC font {SCFontSource} not found, download it from https://github.com/notofonts/noto-cjk"
+        )
+    pdfmetrics.registerFont(TTFont(SCFontName, SCFontSource))
+    return SCFontName
 
 
 @dataclass
@@ -34,14 +72,27 @@ def get_default_en_font(scaler: int) -> FontInfo:
     return FontInfo("Times-Roman", 28 * scaler, colors.red)
 
 
+def get_default_note_font(scaler: int) -> FontInfo:
+    return FontInfo(SCFontName, 12 * scaler, colors.red)
+
+
+def get_font_signature() -> tuple:
+    """
+    fonts and layout used by the default signer, a change invalidates cached overlays.
+    Subsets draw the same glyphs, so the full font stands for them.
+    """
+    font_size = osp.getsize(AbsSCFontPath) if osp.exists(AbsSCFontPath) else None
+    return (SCFontName, osp.basename(AbsSCFontPath), font_size, "Times-Roman", LAYOUT_VERSION)
+
+
 # endregion font preset
 
 # DefaultPageWidth, DefaultPageHeight = 595.3, 841.9
 DefaultPageSize = 595.3 * 841.9
 
 
-def get_page_size(src: str) -> tuple[float, float]:
-    reader = PdfReader(src)
+def get_page_size(src: str | PdfReader) -> tuple[float, float]:
+    reader = src if isinstance(src, PdfReader) else PdfReader(src)
     assert len(reader.pages) > 0, "Empty PDF provided"
     page = reader.pages[0]
     _, _, w, h = page.mediabox
@@ -49,18 +100,21 @@ def get_page_size(src: str) -> tuple[float, float]:
     return (w, h)
 
 
+def get_scaler(width: float, height: float) -> int:
+    """font scaler for pages larger or smaller than A4"""
+    return math.ceil((abs(width * height - DefaultPageSize) + 1e-6) / DefaultPageSize)
+
+
 def get_text_size(text: str, fontname, fontsize) -> tuple[float, float]:
     """
     :return: (width, height) in float
     """
-    w = pdfmetrics.stringWidth(text, fontname, fontsize)
-    asc, dsc = pdfmetrics.getAscentDescent(fontname, fontsize)
-    h = asc - dsc
-    return (w, h)
+    metrics = get_metrics(fontname, fontsize)
+    return (metrics.width(text), metrics.height)
 
 
 def create_sign_pdf(
-    pdfname: str,
+    pdfname: Optional[str],
     content: str,
     pagesize: tuple[float, float] | str,
     extra: Optional[str] = None,
@@ -68,11 +122,11 @@ def create_sign_pdf(
     loff=5,
     font_primary: Optional[FontInfo] = None,
     font_secondary: Optional[FontInfo] = None,
-):
+) -> Optional[bytes]:
     """
     Create a signed pdf with content and outilier rectangle.
     Args:
-        pdfname: str, output pdf file name
+        pdfname: str, output pdf file name. The pdf is rendered in memory and returned as bytes if it is None.
         content: str, content to be signed
         xstart: float, x coordinate of the start of the content, default is 10. The origin is at the top left corner of the page. (Different from the origin of the coordinate system in math which is the standard view of reportlab.)
         loff: float, coordinate offset for rect, default is 5.
@@ -87,11 +141,12 @@ def create_sign_pdf(
     else:
         raise TypeError("pagesize should be a str or a tuple of (width, height)")
 
-    scaler = math.ceil((abs(width * height - DefaultPageSize) + 1e-6) / DefaultPageSize)
+    scaler = get_scaler(width, height)
     font_primary = font_primary if font_primary else get_default_en_font(scaler)
     font_secondary = font_secondary if font_secondary else get_default_zh_font(scaler)
 
-    c = canvas.Canvas(pdfname, pagesize=(width, height))
+    buffer = BytesIO() if pdfname is None else None
+    c = canvas.Canvas(pdfname or buffer, pagesize=(width, height))
 
     # draw score text
     c.setFillColor(font_primary.color)
@@ -106,52 +161,162 @@ def create_sign_pdf(
 
     if extra is not None:
         # draw extra text if provided
-        c.setFillColor(font_secondary.color)
-        c.setFont(font_secondary.name, font_secondary.size)
+        if font_secondary.name == SCFontName:
+            register_sc_font()
         ex, ey = x + tw + 2 * loff, th
-
-        width_limit = width - ex
-        extra_lines = extra.split("\n")
-        max_line_width = max(
-            (get_text_size(line, font_secondary.name, font_secondary.size)[0] for line in extra_lines)
+        # wrapped within the page, shrunk only if the lines run off its bottom
+        layout = layout_text(
+            extra, font_secondary.name, font_secondary.size,
+            round(width - ex - loff, 2), round(height - ey, 2), leading=loff,
         )
-        line_height = get_text_size(extra, font_secondary.name, font_secondary.size)[1] + loff
-        if max_line_width > width_limit:
-            # resize for line fit
-            fit_size = font_secondary.size * (width_limit - loff) / max_line_width
-            c.setFontSize(fit_size)
-        for line in extra_lines:
+        c.setFillColor(font_secondary.color)
+        c.setFont(font_secondary.name, layout.size)
+        for line in layout.lines:
             c.drawString(ex, height - ey, line)
-            ey += line_height
+            ey += layout.line_height
 
     c.showPage()
     c.save()
+    return buffer.getvalue() if buffer is not None else None
+
+
+@dataclass
+class Annotation:
+    """feedback drawn on a page of a submission"""
+
+    page: int  # starts from 1
+    x: float  # of the top left corner of the text, the origin is at the top left corner of the page
+    y: float
+    text: str
+    colour: Optional[str] = None  # reportlab color name or hex code, red by default
+
+
+def create_annotation_pdf(pages: list[tuple[tuple[float, float], list[Annotation]]]) -> bytes:
+    """
+    Render annotations in a single canvas, one pdf page for each annotated page.
+    Args:
+        pages: (page size, annotations on the page) of each annotated page in order
+    """
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer)
+    register_sc_font()
+    for (width, height), notes in pages:
+        c.setPageSize((width, height))
+        font = get_default_note_font(get_scaler(width, height))
+        for note in notes:
+            layout = layout_text(note.text, font.name, font.size, round(width - note.x, 2), round(height - note.y, 2))
+            c.setFillColor(colors.toColor(note.colour) if note.colour else font.color)
+            c.setFont(font.name, layout.size)
+            y = note.y + layout.line_height
+            for line in layout.lines:
+                c.drawString(note.x, height - y, line)
+                y += layout.line_height
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def _annotation_pages(src: PdfReader, annotations: Optional[list[Annotation]]) -> dict[int, PageObject]:
+    """overlay of each annotated page index of `src`, only the annotated pages are loaded"""
+    if not annotations:
+        return {}
+    count = len(src.pages)
+    by_page: dict[int, list[Annotation]] = {}
+    for note in annotations:
+        if not 1 <= note.page <= count:
+            raise IndexError(f"annotation on page {note.page} of a pdf with {count} pages")
+        by_page.setdefault(note.page - 1, []).append(note)
+    metrics.count("annotations", len(annotations))
+    indices = sorted(by_page)
+    with metrics.stage("annotate"):
+        pages = []
+        for idx in indices:
+            _, _, w, h = src.pages[idx].mediabox
+            pages.append(((float(w), float(h)), by_page[idx]))
+        rendered = PdfReader(BytesIO(create_annotation_pdf(pages)))
+        return dict(zip(indices, rendered.pages))
 
 
 def mark_task(
-    src_pdf: str,
+    src_pdf: str | BinaryIO,
     content: str,
-    sign_pdf: str,
-    out_pdf: str,
+    sign_pdf: Optional[str],
+    out_pdf: str | BinaryIO,
     extra: Optional[str] = None,
     signer: Callable[
-        [str, str, tuple[float, float] | str, Optional[str]], None
+        [Optional[str], str, tuple[float, float] | str, Optional[str]], Optional[bytes]
     ] = create_sign_pdf,
+    incremental: bool = False,
+    cache: Optional[OverlayCache] = None,
+    annotations: Optional[list[Annotation]] = None,
 ):
     """
     Args:
-        src_pdf: str, input pdf file name
+        src_pdf: str, input pdf file name or a seekable binary stream
         content: str, content to be signed
-        sign_pdf: str, output pdf file name for the signature (temporary file)
-        out_pdf: str, output pdf file name for the marked task
+        sign_pdf: str, output pdf file name for the signature (temporary file). None for in-memory signature.
+        out_pdf: str, output pdf file name for the marked task or a binary stream
+        signer: signature creator called as `signer(sign_pdf, content, pagesize, extra)`.
+            It either returns the signature pdf as bytes or writes it to `sign_pdf` and returns None.
+        incremental: append the signature as an incremental update instead of rewriting the whole pdf.
+            It falls back to rewriting for pdfs which can not be updated incrementally (e.g. encrypted).
+        cache: reuse overlays rendered for the same content, extra and page size
+        annotations: feedback drawn on the pages they refer to, the score stays on the first page
     """
-    signer(sign_pdf, content, src_pdf, extra)
-    src = PdfReader(src_pdf)
-    sign = PdfReader(sign_pdf)
-    pages = src.pages
-    pages[0].merge_page(sign.pages[0])
-    out = PdfWriter()
-    for p in pages:
-        out.add_page(p)
-    out.write(out_pdf)
-    out.close()
+    if not incremental:
+        with metrics.stage("read"):
+            src = PdfReader(src_pdf)
+        sign = _sign_page(src, content, sign_pdf, extra, signer, cache)
+        notes = _annotation_pages(src, annotations)
+        pages = src.pages
+        metrics.count("pages", len(pages))
+        with metrics.stage("merge"):
+            pages[0].merge_page(sign)
+            for idx, overlay in notes.items():
+                pages[idx].merge_page(overlay)
+        with metrics.stage("write"):
+            out = PdfWriter()
+            for p in pages:
+                out.add_page(p)
+            out.write(out_pdf)
+            out.close()
+        return
+
+    with open(src_pdf, "rb") if isinstance(src_pdf, str) else nullcontext(src_pdf) as fd:
+        # objects are loaded on demand from the file object, so untouched pages are never parsed
+        with metrics.stage("read"):
+            src = PdfReader(fd)
+        sign = _sign_page(src, content, sign_pdf, extra, signer, cache)
+        overlays = {0: [sign]}
+        for idx, overlay in _annotation_pages(src, annotations).items():
+            overlays.setdefault(idx, []).append(overlay)
+        try:
+            with metrics.stage("write"):
+                append_overlays(src, src_pdf, out_pdf, overlays)
+        except ValueError:
+            metrics.count("incremental_fallbacks")
+            fd.seek(0)
+            mark_task(fd, content, sign_pdf, out_pdf, extra, signer, cache=cache, annotations=annotations)
+
+
+def _sign_page(src: PdfReader, content, sign_pdf, extra, signer, cache) -> PageObject:
+    with metrics.stage("page_size"):
+        pagesize = get_page_size(src)
+
+    def render() -> bytes:
+        metrics.count("renders")
+        with metrics.stage("render"):
+            signature = signer(sign_pdf, content, pagesize, extra)
+            if signature is None:
+                with open(sign_pdf, "rb") as fd:
+                    signature = fd.read()
+        return signature
+
+    if cache is None:
+        return PdfReader(BytesIO(render())).pages[0]
+    width, height = float(pagesize[0]), float(pagesize[1])
+    key = overlay_key(
+        content, extra, round(width, 2), round(height, 2), get_scaler(width, height),
+        get_font_signature(), signer.__module__, signer.__qualname__,
+    )
+    return cache.get(key, render)
@@ -0,0 +1,78 @@
+"""
+Cache of rendered signature overlays.
+
+Most submissions of a task share a handful of scores without reasons, so the same
+signature pdf would be rendered again and again. The cache keeps the parsed overlay
+pages in memory (LRU bounded) and optionally persists the rendered pdf on disk.
+"""
+
+import hashlib
+import os
+import os.path as osp
+from collections import OrderedDict
+from io import BytesIO
+from typing import Callable, Optional
+
+from pypdf import PdfReader, PageObject
+
+
+def overlay_key(*parts) -> str:
+    """digest of all parts affecting the rendered overlay"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class OverlayCache:
+    def __init__(self, maxsize: int = 32, cache_dir: Optional[str] = None):
+        """
+        Args:
+            maxsize: max number of overlays kept in memory, the least recently used one is evicted first
+            cache_dir: directory to persist rendered overlays between runs, disabled if None
+        """
+        assert maxsize > 0, f"maxsize should be positive, got {maxsize}"
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.hits, self.misses = 0, 0
+        self._pages: OrderedDict[str, PageObject] = OrderedDict()
+        if cache_dir and not osp.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def _path(self, key: str) -> str:
+        return osp.join(self.cache_dir, f"{key}.pdf")
+
+    def _load(self, key: str) -> Optional[bytes]:
+        if self.cache_dir and osp.exists(self._path(key)):
+            with open(self._path(key), "rb") as fd:
+                return fd.read()
+        return None
+
+    def _store(self, key: str, data: bytes):
+        if not self.cache_dir:
+            return
+        # written aside and renamed, other markers may share the directory
+        tmp = f"{self._path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(data)
+        os.replace(tmp, self._path(key))
+
+    def get(self, key: str, render: Callable[[], bytes]) -> PageObject:
+        """
+        Get the overlay page of `key`, `render` is called to create the overlay pdf on a miss.
+        """
+        if key in self._pages:
+            self.hits += 1
+            self._pages.move_to_end(key)
+            return self._pages[key]
+
+        self.misses += 1
+        data = self._load(key)
+        if data is None:
+            data = render()
+            self._store(key, data)
+        page = PdfReader(BytesIO(data)).pages[0]
+        self._pages[key] = page
+        if len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+        return page
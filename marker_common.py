@@ -1,45 +1,103 @@
+import csv
 import os
 import os.path as osp
-from logger import get_default_logger
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import astuple, dataclass
+from functools import partial
+from typing import Optional
 
-from marker_base import mark_task
+from logger import get_default_logger, metrics
+
+from marker_base import AbsSCFontPath, Annotation, get_font_signature, mark_task, set_sc_font_source
+from marker_cache import OverlayCache
+from marker_font import USER_SUBSET_DIR, collect_chars, subset_font
+from marker_manifest import Manifest
+from marker_notebook import mark_notebook_task
+from marker_pipeline import pipelined_marker
+from marker_zip import mark_zip_task
 
 logger = get_default_logger()
 
-def assignment_marker(
+_overlay_cache: Optional[OverlayCache] = None
+
+
+def get_overlay_cache(cache_size: int, cache_dir: Optional[str]) -> Optional[OverlayCache]:
+    """overlay cache of the current process, each worker process builds its own"""
+    global _overlay_cache
+    if cache_size <= 0:
+        return None
+    if _overlay_cache is None or (_overlay_cache.maxsize, _overlay_cache.cache_dir) != (cache_size, cache_dir):
+        _overlay_cache = OverlayCache(cache_size, cache_dir)
+    return _overlay_cache
+
+
+@dataclass
+class MarkJob:
+    src: str
+    tgt: str
+    content: str
+    extra: Optional[str] = None
+    annotations: Optional[list[Annotation]] = None
+
+
+def load_annotations(path: str) -> dict[str, list[Annotation]]:
+    """
+    Annotations of each sid in a csv file with the columns of ANNOTATION_HEADER, the colour is optional.
+    Texts are quoted if they hold commas or line breaks.
+    """
+    annotations = {}
+    with open(path, encoding="utf-8-sig", newline="") as fd:
+        rows = csv.reader(fd)
+        next(rows, None)  # header
+        for line, row in enumerate(rows, 2):
+            if not any(row):
+                continue
+            assert len(row) in (5, 6), f"unexpected annotation at line {line} of {path}: {row}"
+            sid, page, x, y, text = row[:5]
+            colour = row[5].strip() if len(row) == 6 and row[5].strip() else None
+            annotations.setdefault(sid.strip(), []).append(Annotation(int(page), float(x), float(y), text, colour))
+    return annotations
+
+
+def collect_mark_jobs(
     src_dir: str,
-    tgt_pre: str = "dist",
-    *,
-    tmp_file: str = "tmp.pdf",
+    tgt_dir: str,
     reason_limit: int = 0,
     deduction: str = "deduction.csv",
-):
+    annotations: Optional[str] = None,
+) -> list[MarkJob]:
     """
-    Assignments marker for standardized daily submissions.
+    Collect the files to be marked in `src_dir` sorted by file name.
+    Files which can not be marked automatically are logged and skipped.
+    Args:
+        annotations: csv file of the annotations in `src_dir`, see load_annotations
     """
-    assert osp.exists(src_dir)
-    tgt_dir = osp.join(tgt_pre, src_dir)
-    if not osp.exists(tgt_dir):
-        os.mkdir(tgt_dir)
-
-    logger.info(f"Marking assignments in {src_dir}")
+    reasons = {}
     if reason_limit > 0:
         logger.info(f"Limit for score reason: {reason_limit}")
-        reasons = {}
-        with open(osp.join(src_dir, deduction)) as fd:
-            lines = fd.read().splitlines()[1:]
-        for line in lines:
-            sid, name, reason = line.split(",")
-            reasons[sid] = reason  # .replace('，','\n')
-    for f in os.listdir(src_dir):
-        if f.endswith(".csv"):
-            continue
-        if not f.endswith(".pdf"):
+        with open(osp.join(src_dir, deduction), encoding="utf-8-sig", newline="") as fd:
+            rows = list(csv.reader(fd))[1:]
+        for row in rows:
+            if row:
+                reasons[row[0]] = row[2]  # sid, name, reason[, delta]
+    notes = load_annotations(osp.join(src_dir, annotations)) if annotations else {}
+
+    jobs = []
+    for f in sorted(os.listdir(src_dir)):
+        if f.endswith(".csv") or f.startswith("."):
+            continue  # tables and hidden files (e.g. .hashes.json, .pregrade.journal) as in indexer
+        if not f.endswith((".pdf", ".zip", ".ipynb")):
             logger.info(f"{src_dir}/{f} needs manual marking")
             continue
         src = osp.join(src_dir, f)
         tgt = osp.join(tgt_dir, f)
-        sid, _, _, content = osp.basename(src).split(".")[-2].split("-")  # get score from file name
+        fields = osp.basename(src).split(".")[-2].split("-")
+        if len(fields) != 4:
+            logger.info(f"{src} is not scored yet")
+            continue
+        sid, _, _, content = fields  # get score from file name
         # reason for low score
         extra = None
         try:
@@ -50,5 +108,236 @@ def assignment_marker(
         except ValueError:
             logger.error(f"unexpected score: {content} when processing {src}")
             continue
+        if sid in notes and not f.endswith(".pdf"):
+            logger.info(f"annotations of {src} are skipped, they are only drawn on pdfs")
+        jobs.append(MarkJob(src, tgt, content, extra, notes.get(sid) if f.endswith(".pdf") else None))
+    return jobs
+
+
+def prepare_sc_font(jobs: list[MarkJob]) -> Optional[str]:
+    """
+    Subset the SC font to the characters of the scores and reasons of the jobs.
+    Returns:
+        path of the subset, None for the full font
+    """
+    if not any(job.extra or job.annotations for job in jobs) or not osp.exists(AbsSCFontPath):
+        return None  # the SC font is not drawn
+    chars = collect_chars(
+        text for job in jobs for text in (job.content, job.extra, *(note.text for note in job.annotations or ()))
+    )
+    error = None
+    for cache_dir in (None, USER_SUBSET_DIR):
+        try:
+            return subset_font(AbsSCFontPath, chars, cache_dir)
+        except ImportError:
+            logger.info("fontTools is not installed, the full SC font is used")
+            return None
+        except OSError as e:  # e.g. read-only next to a shared font
+            error = e
+    logger.info(f"the subset can not be cached ({error}), the full SC font is used")
+    return None
+
+
+def worker_tmp_file(tmp_file: str) -> str:
+    """
+    Signature file owned by the current process, so that concurrent markers never share it.
+    """
+    root, ext = osp.splitext(tmp_file)
+    return f"{root}.{socket.gethostname()}.{os.getpid()}{ext}"  # machines may share the directory
+
+
+def run_mark_job(
+    job: MarkJob,
+    tmp_file: Optional[str] = None,
+    incremental: bool = False,
+    cache_size: int = 0,
+    cache_dir: Optional[str] = None,
+    zip_pattern: str = "*.pdf",
+) -> tuple[Optional[str], dict]:
+    """
+    Mark a single job. The signature stays in memory unless `tmp_file` is given.
+    Reports in zip submissions are found by `zip_pattern`.
+    Returns:
+        None on success, otherwise the error message
+        timings of the job, see `logger.Metrics.track_file`
+    """
+    sign_pdf = worker_tmp_file(tmp_file) if tmp_file else None
+    with metrics.track_file(job.src) as timings:
+        err = _run_mark_job(job, sign_pdf, incremental, cache_size, cache_dir, zip_pattern)
+    return err, timings
+
+
+def _run_mark_job(job, sign_pdf, incremental, cache_size, cache_dir, zip_pattern) -> Optional[str]:
+    # written next to the target and renamed into place, so a target is never partially written
+    out = f"{job.tgt}.{socket.gethostname()}.{os.getpid()}.tmp"
+    try:
+        cache = get_overlay_cache(cache_size, cache_dir)
+        if job.src.endswith(".zip"):
+            mark_zip_task(
+                job.src, job.content, sign_pdf, out, job.extra,
+                pattern=zip_pattern, incremental=incremental, cache=cache,
+            )
+        elif job.src.endswith(".ipynb"):
+            mark_notebook_task(job.src, job.content, out, job.extra)
+        else:
+            mark_task(
+                job.src, job.content, sign_pdf, out, job.extra,
+                incremental=incremental, cache=cache, annotations=job.annotations,
+            )
+        os.replace(out, job.tgt)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    finally:
+        for tmp in (sign_pdf, out):
+            if tmp and osp.exists(tmp):
+                os.remove(tmp)
+    return None
+
+
+def plan_mark_jobs(
+    src_dir: str,
+    tgt_dir: str,
+    reason_limit: int = 0,
+    deduction: str = "deduction.csv",
+    incremental: bool = False,
+    force: bool = False,
+    hash_sources: bool = False,
+    zip_pattern: str = "*.pdf",
+    remove_stale: bool = True,
+    annotations: Optional[str] = None,
+) -> tuple[Manifest, list[tuple[MarkJob, dict]]]:
+    """
+    Jobs of `src_dir` to be marked with their signatures, see assignment_marker for the arguments.
+    Args:
+        remove_stale: delete the outputs of submissions which are gone and drop them from the manifest
+    """
+    jobs = collect_mark_jobs(src_dir, tgt_dir, reason_limit, deduction, annotations)
+    manifest = Manifest(tgt_dir, hash_sources)
+    if remove_stale:
+        for output in manifest.remove_stale({osp.basename(job.tgt) for job in jobs}):
+            logger.info(f"stale output {output} removed")
+    fonts = get_font_signature()
+    pending = []
+    for job in jobs:
+        sig = manifest.signature(
+            job.src, content=job.content, extra=job.extra, fonts=fonts, incremental=incremental,
+            zip_pattern=zip_pattern if job.src.endswith(".zip") else None,
+            # only annotated outputs carry them, so adding annotations leaves the others current
+            **({"annotations": [astuple(note) for note in job.annotations]} if job.annotations else {}),
+        )
+        if force or not manifest.is_current(osp.basename(job.tgt), sig):
+            pending.append((job, sig))
+    if len(pending) < len(jobs):
+        logger.info(f"{len(jobs) - len(pending)} files are up to date")
+    return manifest, pending
+
+
+def assignment_marker(
+    src_dir: str,
+    tgt_pre: str = "dist",
+    *,
+    tmp_file: Optional[str] = None,
+    reason_limit: int = 0,
+    deduction: str = "deduction.csv",
+    workers: int = 1,
+    incremental: bool = False,
+    cache_size: int = 32,
+    cache_dir: Optional[str] = None,
+    force: bool = False,
+    hash_sources: bool = False,
+    zip_pattern: str = "*.pdf",
+    metrics_file: Optional[str] = None,
+    pipeline: int = 0,
+    font_subset: bool = True,
+    watch: bool = False,
+    interval: float = 1.0,
+    debounce: float = 2.0,
+    annotations: Optional[str] = None,
+):
+    """
+    Assignments marker for standardized daily submissions.
+    Outputs are recorded in a manifest of the target directory, so a rerun only marks new or
+    changed submissions and removes the outputs of submissions which are gone (e.g. renamed).
+    Args:
+        tmp_file: signature file used by each process, default is None to keep the signature in memory.
+        workers: number of processes to mark files with, default is 1 (serial).
+            Failures are collected per file and reported in file name order.
+        incremental: append the stamp to each pdf as an incremental update instead of rewriting it.
+        cache_size: number of rendered overlays reused across files per process, 0 to disable.
+        cache_dir: directory to persist rendered overlays between runs.
+        force: mark all submissions again regardless of the manifest.
+        hash_sources: detect changed submissions by content hash instead of size and mtime.
+        zip_pattern: glob pattern of the report pdfs stamped in zip submissions.
+        metrics_file: JSON-lines file to append the stage timings of each file and of the run to.
+        pipeline: queue depth to read ahead and write behind the stamping in threads, 0 to disable.
+            It overlaps the file I/O (e.g. on a network share) with the compute of a single process.
+        font_subset: register a subset of the SC font with the characters of the task only.
+        watch: keep marking the submissions as they are scored until interrupted.
+        interval: seconds between the checks of `src_dir` when watching.
+        debounce: seconds without changes in `src_dir` before marking when watching.
+        annotations: csv file in `src_dir` of the feedback drawn on the pages of pdf submissions,
+            with the columns sid,page,x,y,text[,colour]. x and y are in points from the top left corner.
+    """
+    if watch:
+        from marker_watch import watch_marker
+
+        # every other argument of this call is passed on to each run
+        kwargs = {k: v for k, v in locals().items() if k not in ("watch", "interval", "debounce", "watch_marker")}
+        watch_marker(src_dir, partial(assignment_marker, **kwargs), interval, debounce)
+        return
+    assert osp.exists(src_dir)
+    assert workers > 0, f"workers should be positive, got {workers}"
+    assert pipeline == 0 or workers == 1, "pipeline runs in a single process, set either pipeline or workers"
+    tgt_dir = osp.join(tgt_pre, src_dir)
+    if not osp.exists(tgt_dir):
+        os.mkdir(tgt_dir)
+
+    metrics.reset(metrics_file)
+    logger.info(f"Marking assignments in {src_dir}")
+    manifest, pending = plan_mark_jobs(
+        src_dir, tgt_dir, reason_limit, deduction, incremental, force, hash_sources, zip_pattern,
+        annotations=annotations,
+    )
+
+    runner = partial(
+        run_mark_job, tmp_file=tmp_file, incremental=incremental,
+        cache_size=cache_size, cache_dir=cache_dir, zip_pattern=zip_pattern,
+    )
+    font = prepare_sc_font([job for job, _ in pending]) if font_subset else None
+    set_sc_font_source(font)
+    if workers > 1:
+        logger.info(f"Marking {len(pending)} files with {workers} workers")
+    failures = []
+    with (
+        # workers register the same font whether they are forked or spawned
+        ProcessPoolExecutor(max_workers=workers, initializer=set_sc_font_source, initargs=(font,))
+        if workers > 1 else nullcontext()
+    ) as pool:
+        # both keep the submission order regardless of completion order
+        todo = [job for job, _ in pending]
+        if pipeline > 0:
+            results = pipelined_marker(
+                todo, pipeline, worker_tmp_file(tmp_file) if tmp_file else None,
+                incremental, get_overlay_cache(cache_size, cache_dir), zip_pattern,
+            )
+        else:
+            results = pool.map(runner, todo) if pool else map(runner, todo)
+        for (job, sig), (err, timings) in zip(pending, results, strict=True):  # a lost result is an error
+            metrics.add_file(timings)
+            if err is None and not manifest.unchanged(job.src, sig):
+                # renamed or rewritten while being marked, the next run marks the latest one
+                logger.info(f"{job.src} changed while marking, skipped")
+                if osp.exists(job.tgt):
+                    os.remove(job.tgt)
+            elif err is None:
+                manifest.record(osp.basename(job.tgt), sig)  # recorded at once to resume after a crash
+            else:
+                failures.append((job, err))
+    manifest.compact()
 
-        mark_task(src, content, tmp_file, tgt, extra)
+    for job, err in failures:
+        logger.error(f"{job.src} failed: {err}")
+    run = metrics.finish(src_dir=src_dir, workers=workers, incremental=incremental, failures=len(failures))
+    logger.info(f"{len(pending) - len(failures)}/{len(pending)} files marked in {tgt_dir} in {run['seconds']:.2f}s")
+    if run["stages"]:
+        logger.info("stages: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in run["stages"].items()))
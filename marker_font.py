@@ -0,0 +1,66 @@
+"""
+Subsets of the SC font for a marking run.
+
+Parsing the full CJK font takes most of the font registration, while a task only draws the
+characters of its reasons and scores. A subset with just those characters is built once per
+character set and cached next to the font (or in the user cache if that is read-only), so reruns
+of a task reuse it.
+Requires fontTools (pip install fonttools), the full font is used without it.
+"""
+
+import hashlib
+import os
+import os.path as osp
+from typing import Iterable, Optional
+
+SUBSET_DIR = "subsets"  # under the directory of the font
+# used when the directory of the font is read-only, e.g. a shared install
+USER_SUBSET_DIR = osp.join(os.environ.get("XDG_CACHE_HOME") or osp.expanduser("~/.cache"), "marker4ta", SUBSET_DIR)
+
+
+def collect_chars(texts: Iterable[Optional[str]]) -> str:
+    """sorted distinct characters drawn for `texts`"""
+    chars = set()
+    for text in texts:
+        if text:
+            chars.update(text)
+    chars.discard("\n")
+    return "".join(sorted(chars))
+
+
+def subset_path(font_path: str, chars: str, cache_dir: Optional[str] = None) -> str:
+    """cache file of the subset, keyed by the font file and the characters"""
+    st = os.stat(font_path)
+    key = hashlib.sha1(f"{osp.abspath(font_path)}|{st.st_size}|{st.st_mtime_ns}|{chars}".encode()).hexdigest()
+    root, ext = osp.splitext(osp.basename(font_path))
+    cache_dir = cache_dir or osp.join(osp.dirname(font_path), SUBSET_DIR)
+    return osp.join(cache_dir, f"{root}-{key[:16]}{ext}")
+
+
+def subset_font(font_path: str, chars: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Build (or reuse) the subset of `font_path` with `chars`.
+    Returns:
+        path of the subset font
+    Raises:
+        ImportError: fontTools is not installed
+    """
+    path = subset_path(font_path, chars, cache_dir)
+    if osp.exists(path):
+        return path
+    from fontTools import subset
+
+    options = subset.Options()
+    options.notdef_outline = True  # drawn for characters out of the subset
+    options.name_IDs = ["*"]
+    options.name_languages = ["*"]
+    font = subset.load_font(font_path, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=chars)
+    subsetter.subset(font)
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    subset.save_font(font, tmp, options)
+    font.close()
+    os.replace(tmp, path)
+    return path
@@ -0,0 +1,286 @@
+"""
+Append stamps to a PDF as an incremental update (ISO 32000-1 7.5.6).
+
+The original bytes are copied through untouched and only the stamped pages, their
+overlay objects and a new cross-reference section are appended, so the cost of marking
+depends on the stamp instead of the size of the submission.
+"""
+
+import re
+import shutil
+from contextlib import nullcontext
+from typing import BinaryIO, Optional
+
+from pypdf import PdfReader, PageObject
+from pypdf.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    PdfObject,
+    StreamObject,
+)
+
+STAMP_PREFIX = "/MarkerStamp"
+TAIL_SIZE = 1024
+
+
+def _open(file: str | BinaryIO, mode: str):
+    """open a file name, or use a binary stream as it is"""
+    return open(file, mode) if isinstance(file, str) else nullcontext(file)
+
+
+def find_startxref(src_pdf: str | BinaryIO) -> Optional[int]:
+    """
+    Locate the last cross-reference section of a pdf file.
+    Returns:
+        the offset of the section or None if it can not be located
+    """
+    with _open(src_pdf, "rb") as fd:
+        fd.seek(0, 2)
+        size = fd.tell()
+        fd.seek(max(0, size - TAIL_SIZE))
+        tail = fd.read()
+        found = re.findall(rb"startxref\s+(\d+)", tail)
+        if not found:
+            return None
+        offset = int(found[-1])
+        if offset >= size:
+            return None
+        fd.seek(offset)
+        head = fd.read(32)
+    # either a classic table or an xref stream object
+    if head.startswith(b"xref") or re.match(rb"\d+\s+\d+\s+obj", head):
+        return offset
+    return None
+
+
+def supports_incremental(reader: PdfReader) -> bool:
+    """Whether the first pages of `reader` can be stamped by an incremental update."""
+    if reader.is_encrypted or len(reader.pages) == 0:
+        return False
+    return reader.pages[0].indirect_reference is not None
+
+
+class Increment:
+    """
+    Objects to be appended to a pdf as a single incremental update.
+    New objects are numbered after the /Size of the original trailer.
+    """
+
+    def __init__(self, reader: PdfReader):
+        self.reader = reader
+        self.next_id = int(reader.trailer["/Size"])
+        self.objects: dict[int, tuple[int, PdfObject]] = {}  # idnum: (generation, object)
+        self._imported: dict[tuple[int, int, int], IndirectObject] = {}
+
+    def add(self, obj: PdfObject) -> IndirectObject:
+        ref = IndirectObject(self.next_id, 0, None)
+        self.next_id += 1
+        self.objects[ref.idnum] = (0, obj)
+        return ref
+
+    def replace(self, ref: IndirectObject, obj: PdfObject):
+        self.objects[ref.idnum] = (ref.generation, obj)
+
+    def import_object(self, obj: PdfObject) -> PdfObject:
+        """
+        Copy an object of another document (e.g. the signature pdf) into the increment,
+        renumbering all of the indirect objects it refers to.
+        """
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            if key not in self._imported:
+                # reserve the number first for self references
+                self._imported[key] = self.add(NullObject())
+                self.objects[self._imported[key].idnum] = (0, self.import_object(obj.get_object()))
+            return self._imported[key]
+        if isinstance(obj, StreamObject):
+            copied = DecodedStreamObject()
+            copied.set_data(obj._data)  # raw (still encoded) data, /Filter is copied below
+            copied.update({k: self.import_object(v) for k, v in obj.items()})
+            return copied
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({k: self.import_object(v) for k, v in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.import_object(v) for v in obj)
+        return obj
+
+    def _content_stream(self, data: bytes) -> IndirectObject:
+        stream = DecodedStreamObject()
+        stream.set_data(data)
+        return self.add(stream)
+
+    def _stamp_form(self, overlay: PageObject) -> IndirectObject:
+        form = DecodedStreamObject()
+        contents = overlay.get_contents()
+        form.set_data(contents.get_data() if contents is not None else b"")
+        form.update(
+            {
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): ArrayObject(overlay.mediabox),
+                NameObject("/Resources"): self.import_object(
+                    overlay.raw_get("/Resources") if "/Resources" in overlay else DictionaryObject()
+                ),
+            }
+        )
+        return self.add(form.flate_encode())
+
+    def stamp_page(self, page: PageObject, overlays: list[PageObject]):
+        """
+        Draw `overlays` in order on top of `page`, each through a form XObject.
+        Only the page dictionary is rewritten, its original content streams are referenced as-is.
+        """
+        resources = DictionaryObject(page.get("/Resources", DictionaryObject()).items())
+        xobjects = DictionaryObject(resources.get("/XObject", DictionaryObject()).items())
+        names, idx = [], 0
+        for overlay in overlays:
+            while NameObject(f"{STAMP_PREFIX}{idx}") in xobjects:
+                idx += 1
+            name = NameObject(f"{STAMP_PREFIX}{idx}")
+            xobjects[name] = self._stamp_form(overlay)
+            names.append(name)
+        resources[NameObject("/XObject")] = xobjects
+
+        contents = []
+        if "/Contents" in page:
+            raw = page.raw_get("/Contents")
+            resolved = raw.get_object()
+            contents = list(resolved) if isinstance(resolved, ArrayObject) else [raw]
+        # isolate the graphics state of the original contents from the stamp
+        push = self._content_stream(b"q\n")
+        pop = self._content_stream(b"\nQ" + b"".join(b" q " + name.encode() + b" Do Q" for name in names) + b"\n")
+
+        stamped = DictionaryObject(page.items())
+        stamped[NameObject("/Resources")] = resources
+        stamped[NameObject("/Contents")] = ArrayObject([push, *contents, pop])
+        self.replace(page.indirect_reference, stamped)
+
+    def _write_objects(self, out) -> dict[int, tuple[int, int]]:
+        positions = {}  # idnum: (offset, generation)
+        for idnum in sorted(self.objects):
+            gen, obj = self.objects[idnum]
+            positions[idnum] = (out.tell(), gen)
+            out.write(f"{idnum} {gen} obj\n".encode())
+            obj.write_to_stream(out)
+            out.write(b"\nendobj\n")
+        return positions
+
+    def _trailer(self, prev: int) -> DictionaryObject:
+        trailer = DictionaryObject(
+            {
+                NameObject("/Size"): NumberObject(self.next_id),
+                NameObject("/Prev"): NumberObject(prev),
+            }
+        )
+        for key in ("/Root", "/Info", "/ID"):
+            if key in self.reader.trailer:
+                trailer[NameObject(key)] = self.reader.trailer.raw_get(key)
+        return trailer
+
+    def write(self, out, prev: int, xref_stream: bool = False):
+        """
+        Append the objects and a cross-reference section to `out` which holds the original pdf.
+        Args:
+            prev: offset of the previous cross-reference section
+            xref_stream: whether to write the section as a stream (required when the original uses one)
+        """
+        if xref_stream:
+            xref_id = self.next_id
+            self.next_id += 1
+        positions = self._write_objects(out)
+        if xref_stream:
+            positions[xref_id] = (out.tell(), 0)
+        ids = sorted(positions)
+        # contiguous runs of object numbers as subsections
+        runs = []
+        for idnum in ids:
+            if runs and runs[-1][0] + runs[-1][1] == idnum:
+                runs[-1][1] += 1
+            else:
+                runs.append([idnum, 1])
+
+        trailer = self._trailer(prev)
+        startxref = out.tell()
+        if xref_stream:
+            width = max(1, (startxref.bit_length() + 7) // 8)
+            data = b"".join(
+                b"\x01" + positions[i][0].to_bytes(width, "big") + positions[i][1].to_bytes(2, "big")
+                for i in ids
+            )
+            xref = DecodedStreamObject()
+            xref.set_data(data)
+            xref.update(trailer)
+            xref.update(
+                {
+                    NameObject("/Type"): NameObject("/XRef"),
+                    NameObject("/W"): ArrayObject([NumberObject(1), NumberObject(width), NumberObject(2)]),
+                    NameObject("/Index"): ArrayObject(NumberObject(n) for run in runs for n in run),
+                }
+            )
+            out.write(f"{xref_id} 0 obj\n".encode())
+            xref.write_to_stream(out)
+            out.write(b"\nendobj\n")
+        else:
+            # a free entry for object 0 keeps readers from "repairing" the first subsection
+            out.write(b"xref\n0 1\n0000000000 65535 f\r\n")
+            for start, count in runs:
+                out.write(f"{start} {count}\n".encode())
+                for idnum in range(start, start + count):
+                    offset, gen = positions[idnum]
+                    out.write(f"{offset:010d} {gen:05d} n\r\n".encode())
+            out.write(b"trailer\n")
+            trailer.write_to_stream(out)
+            out.write(b"\n")
+        out.write(f"startxref\n{startxref}\n%%EOF\n".encode())
+
+
+def append_overlays(
+    reader: PdfReader,
+    src_pdf: str | BinaryIO,
+    out_pdf: str | BinaryIO,
+    overlays: dict[int, PageObject | list[PageObject]],
+):
+    """
+    Write `src_pdf` to `out_pdf` with each page index in `overlays` stamped by an incremental update.
+    Args:
+        reader: reader of `src_pdf`, it should be opened on a file object so that only the
+            required objects are loaded into memory
+        src_pdf: file name or seekable binary stream of the original pdf
+        out_pdf: file name or binary stream (positioned at its start) to write to
+        overlays: page index: overlay page (or pages, drawn in order) to be drawn on it.
+            Pages without overlays are neither parsed nor rewritten.
+    Raises:
+        ValueError: the pdf can not be updated incrementally
+    """
+    prev = find_startxref(src_pdf)
+    if prev is None or not supports_incremental(reader):
+        raise ValueError(f"{src_pdf} can not be updated incrementally")
+    with _open(src_pdf, "rb") as fd:
+        fd.seek(prev)
+        xref_stream = not fd.read(4).startswith(b"xref")
+        fd.seek(-1, 2)
+        newline = fd.read(1) not in b"\r\n"
+
+    increment = Increment(reader)
+    for idx, overlay in sorted(overlays.items()):
+        increment.stamp_page(reader.pages[idx], overlay if isinstance(overlay, list) else [overlay])
+
+    def finish(out):
+        if newline:
+            out.write(b"\n")
+        increment.write(out, prev, xref_stream)
+
+    if isinstance(src_pdf, str) and isinstance(out_pdf, str):
+        shutil.copyfile(src_pdf, out_pdf)  # copied by the kernel when possible
+        with open(out_pdf, "ab") as out:
+            finish(out)
+    else:
+        with _open(src_pdf, "rb") as fd, _open(out_pdf, "wb") as out:
+            fd.seek(0)
+            shutil.copyfileobj(fd, out)
+            finish(out)
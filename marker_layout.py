@@ -0,0 +1,115 @@
+"""
+Text layout of the stamps.
+
+Advance widths are measured once per character for each (font, size), and lines are wrapped
+greedily within the available width: CJK text breaks between any two characters, except before
+closing punctuation (e.g. "，") or after opening punctuation (e.g. "（"), and other text breaks at
+spaces. The font is only shrunk when the wrapped lines do not fit the available height.
+Layouts are cached, so files with identical reasons are laid out once.
+"""
+
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+from reportlab.pdfbase import pdfmetrics
+
+LAYOUT_VERSION = 1  # part of the overlay signatures, bump it when the same text is laid out differently
+NO_LINE_START = frozenset("，。、；：！？）》」』】〕’”,.;:!?)]}%")
+NO_LINE_END = frozenset("（《「『【〔‘“([{")
+SHRINK = 0.9  # font size factor of each shrinking step
+# whitespace, a run of non-CJK characters, or a single character
+TOKEN_RE = re.compile(r"\s+|[^\s\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef]+|.")
+
+
+class FontMetrics:
+    """widths of a registered font at a size, each character is measured once"""
+
+    def __init__(self, name: str, size: float):
+        self.name = name
+        self.size = size
+        asc, dsc = pdfmetrics.getAscentDescent(name, size)
+        self.height = asc - dsc
+        self.advances: dict[str, float] = {}
+
+    def advance(self, char: str) -> float:
+        width = self.advances.get(char)
+        if width is None:
+            width = self.advances[char] = pdfmetrics.stringWidth(char, self.name, self.size)
+        return width
+
+    def width(self, text: str) -> float:
+        return sum(self.advance(char) for char in text)
+
+
+@lru_cache(maxsize=None)
+def get_metrics(name: str, size: float) -> FontMetrics:
+    """metrics of a registered font, shared by every text drawn with it"""
+    return FontMetrics(name, size)
+
+
+def tokenize(paragraph: str) -> list[str]:
+    """pieces of `paragraph` which are not broken, a line may break between any two of them"""
+    tokens = []
+    glue = False  # after opening punctuation
+    for piece in TOKEN_RE.findall(paragraph):
+        if tokens and (glue or piece[0] in NO_LINE_START or piece.isspace()):
+            tokens[-1] += piece  # trailing spaces are dropped at a line break
+        else:
+            tokens.append(piece)
+        glue = piece[-1] in NO_LINE_END
+    return tokens
+
+
+def wrap(text: str, metrics: FontMetrics, max_width: float) -> list[str]:
+    """greedy line breaking of `text` within `max_width`, line breaks of `text` are kept"""
+    lines = []
+    for paragraph in text.split("\n"):
+        line, used = "", 0.0
+        tokens = tokenize(paragraph)[::-1]
+        while tokens:
+            token = tokens.pop()
+            if used + metrics.width(token.rstrip()) <= max_width or (not line and len(token) == 1):
+                line += token
+                used += metrics.width(token)
+            elif not line:  # longer than a line (e.g. a url), broken between characters
+                tokens.extend(reversed(token))
+            else:
+                lines.append(line.rstrip())
+                line, used = "", 0.0
+                tokens.append(token)
+        lines.append(line.rstrip())
+    return lines
+
+
+@dataclass(frozen=True)
+class Layout:
+    lines: tuple[str, ...]
+    size: float  # font size, smaller than the requested one if the text was shrunk
+    line_height: float  # distance between the baselines
+    width: float  # of the widest line
+
+
+@lru_cache(maxsize=1024)
+def layout_text(
+    text: str,
+    font: str,
+    size: float,
+    max_width: float,
+    max_height: float = float("inf"),
+    leading: float = 0,
+    min_size: float = 6,
+) -> Layout:
+    """
+    Wrap `text` in `font` within `max_width`, shrinking the font only if the lines exceed `max_height`.
+    Args:
+        leading: extra space between lines
+        min_size: the font is not shrunk below it, the lines may exceed `max_height` then
+    """
+    while True:
+        metrics = get_metrics(font, size)
+        lines = wrap(text, metrics, max_width)
+        line_height = metrics.height + leading
+        if len(lines) * line_height <= max_height or size <= min_size:
+            return Layout(tuple(lines), size, line_height, max(metrics.width(line) for line in lines))
+        size = max(min_size, size * SHRINK)
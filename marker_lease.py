@@ -0,0 +1,267 @@
+"""
+Marking a task folder together from several machines sharing the directory, without a broker.
+
+    <tgt_dir>/.leases/<output>.lease          claimed by a worker, created exclusively
+    <tgt_dir>/.leases/<output>.done           finished (or failed) for the signature inside
+    <tgt_dir>/.leases/results-<worker>.jsonl  results of a worker, one line per file
+    <tgt_dir>/.leases/clock-<worker>          touched to read the clock of the file server
+
+A worker touches its lease every ttl / 3 seconds. A lease untouched for `ttl` seconds, by the
+clock of the file server, belongs to a crashed worker and is taken over by renaming it away
+first, so only one worker wins it.
+The renamed lease is checked again, a fresh one renamed by a late worker is put back.
+Workers leave the shared manifest alone; `lease_summary` merges the results into it afterwards.
+"""
+
+import json
+import os
+import os.path as osp
+import socket
+import threading
+import time
+from typing import Optional
+
+from logger import get_default_logger, metrics
+from marker_base import set_sc_font_source
+from marker_common import get_overlay_cache, plan_mark_jobs, prepare_sc_font, run_mark_job
+from marker_manifest import Manifest
+
+logger = get_default_logger()
+
+LEASE_DIR = ".leases"
+
+
+def default_worker() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as fd:
+            return json.load(fd)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_json_atomic(path: str, record: dict):
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fd:
+        json.dump(record, fd, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class Leases:
+    def __init__(self, tgt_dir: str, worker: str, ttl: float = 60):
+        self.root = osp.join(tgt_dir, LEASE_DIR)
+        os.makedirs(self.root, exist_ok=True)
+        self.worker = worker
+        self.ttl = ttl
+        self.held: Optional[str] = None
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def lease_path(self, output: str) -> str:
+        return osp.join(self.root, f"{output}.lease")
+
+    def done_path(self, output: str) -> str:
+        return osp.join(self.root, f"{output}.done")
+
+    def is_done(self, output: str, sig: dict, tgt: str) -> bool:
+        """finished for `sig`, a failure counts as finished while a success needs its output"""
+        done = read_json(self.done_path(output))
+        return done is not None and done["sig"] == sig and (done["error"] is not None or osp.exists(tgt))
+
+    def acquire(self, output: str) -> bool:
+        path = self.lease_path(output)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._steal(path):
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"worker": self.worker, "time": time.time()}, f)
+            self.held = path
+            return True
+        return False
+
+    def now(self) -> float:
+        """current time of the shared filesystem, the clocks of the machines may differ"""
+        clock = osp.join(self.root, f"clock-{self.worker}")
+        with open(clock, "w"):  # stamped by the file server
+            pass
+        return os.stat(clock).st_mtime
+
+    def _expired(self, path: str) -> bool:
+        return self.now() - os.stat(path).st_mtime >= self.ttl
+
+    def _steal(self, path: str) -> bool:
+        """remove the lease at `path` if it expired, only one of the racing workers succeeds"""
+        stale = f"{path}.{self.worker}.stale"
+        try:
+            if not self._expired(path):
+                return False
+            os.rename(path, stale)
+        except FileNotFoundError:  # released or taken over meanwhile
+            return True
+        # another worker may have taken the lease over between the check and the rename,
+        # its fresh lease is put back (unless the name is taken again) and left to it
+        if not self._expired(stale):
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        owner = (read_json(stale) or {}).get("worker")
+        logger.info(f"expired lease {osp.basename(path)} of {owner} taken over")
+        os.remove(stale)
+        return True
+
+    def release(self, output: str, done: Optional[dict] = None):
+        """release the lease of `output`, marking it as `done` if given"""
+        if done is not None:
+            write_json_atomic(self.done_path(output), done)
+        self.held = None
+        try:
+            os.remove(self.lease_path(output))
+        except FileNotFoundError:  # taken over after a stall, the done marker stands anyway
+            pass
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            held = self.held
+            if held is not None:
+                try:
+                    os.utime(held)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        self._stop.set()
+
+
+def lease_marker(
+    src_dir: str,
+    tgt_pre: str = "dist",
+    worker: Optional[str] = None,
+    ttl: float = 60,
+    *,
+    tmp_file: Optional[str] = None,
+    reason_limit: int = 0,
+    deduction: str = "deduction.csv",
+    incremental: bool = False,
+    cache_size: int = 32,
+    cache_dir: Optional[str] = None,
+    force: bool = False,
+    hash_sources: bool = False,
+    zip_pattern: str = "*.pdf",
+    font_subset: bool = True,
+    annotations: Optional[str] = None,
+):
+    """
+    Mark `src_dir` as one of the workers sharing it, run it on each machine (see assignment_marker
+    for the other arguments), then merge the results with `lease_summary`.
+    Args:
+        worker: name of this worker, hostname-pid by default
+        ttl: seconds after which the lease of a silent worker expires
+    """
+    assert osp.exists(src_dir)
+    worker = worker or default_worker()
+    tgt_dir = osp.join(tgt_pre, src_dir)
+    os.makedirs(tgt_dir, exist_ok=True)
+    manifest, pending = plan_mark_jobs(
+        src_dir, tgt_dir, reason_limit, deduction, incremental, force, hash_sources, zip_pattern,
+        remove_stale=False,  # the manifest is only written by lease_summary
+        annotations=annotations,
+    )
+    set_sc_font_source(prepare_sc_font([job for job, _ in pending]) if font_subset else None)
+    get_overlay_cache(cache_size, cache_dir)
+    leases = Leases(tgt_dir, worker, ttl)
+    results = osp.join(leases.root, f"results-{worker}.jsonl")
+    logger.info(f"Worker {worker} marking {len(pending)} files in {src_dir}")
+
+    marked = 0
+    try:
+        while pending:
+            waiting = []
+            for job, sig in pending:
+                output = osp.basename(job.tgt)
+                if leases.is_done(output, sig, job.tgt):
+                    continue
+                if not leases.acquire(output):
+                    waiting.append((job, sig))  # retried once its lease is done or expired
+                    continue
+                if leases.is_done(output, sig, job.tgt):  # finished by the worker which just released it
+                    leases.release(output)
+                    continue
+                err, timings = run_mark_job(job, tmp_file, incremental, cache_size, cache_dir, zip_pattern)
+                if err is None and not manifest.unchanged(job.src, sig):
+                    err = "changed while marking"
+                record = {
+                    "output": output, "src": job.src, "sig": sig, "worker": worker, "error": err,
+                    "time": leases.now(),
+                }
+                with open(results, "a", encoding="utf-8") as fd:
+                    fd.write(json.dumps({**record, "timings": timings}, ensure_ascii=False) + "\n")
+                leases.release(output, record)
+                marked += 1
+            if waiting:
+                time.sleep(min(ttl / 3, 1.0))
+            pending = waiting
+    finally:
+        leases.close()
+    logger.info(f"Worker {worker} marked {marked} files in {tgt_dir}")
+
+
+def lease_summary(src_dir: str, tgt_pre: str = "dist", hash_sources: bool = False, clean: bool = False):
+    """
+    Merge the results of the workers of `src_dir` into the manifest of the target directory.
+    Args:
+        clean: remove the lease directory afterwards
+    """
+    tgt_dir = osp.join(tgt_pre, src_dir)
+    root = osp.join(tgt_dir, LEASE_DIR)
+    manifest = Manifest(tgt_dir, hash_sources)
+    metrics.reset()
+    latest, workers = {}, {}
+    for name in sorted(os.listdir(root)):
+        if not (name.startswith("results-") and name.endswith(".jsonl")):
+            continue
+        with open(osp.join(root, name), encoding="utf-8") as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write of a crashed worker
+                # results files are appended across runs, the newest record of an output wins
+                if record.get("time", 0) >= latest.get(record["output"], {}).get("time", 0):
+                    latest[record["output"]] = record
+                metrics.add_file(record["timings"])
+                count = workers.setdefault(record["worker"], [0, 0.0])
+                count[0] += 1
+                count[1] += record["timings"]["seconds"]
+
+    failures = []
+    for output, record in sorted(latest.items()):
+        if record["error"] is None and osp.exists(osp.join(tgt_dir, output)):
+            manifest.record(output, record["sig"])
+        else:
+            failures.append(record)
+    manifest.compact()
+
+    for worker, (count, seconds) in sorted(workers.items()):
+        print(f"{worker}: {count} files in {seconds:.2f}s")
+    for record in failures:
+        print(f"{record['src']} failed: {record['error']}")
+    leftover = [name for name in os.listdir(root) if name.endswith(".lease")]
+    if leftover:
+        print(f"{len(leftover)} files are still leased: {', '.join(sorted(leftover))}")
+    print(f"{len(latest) - len(failures)}/{len(latest)} files marked in {tgt_dir}")
+    print(metrics.summary(seconds=sum(seconds for _, seconds in workers.values())))
+    if clean and not leftover:
+        for name in os.listdir(root):
+            os.remove(osp.join(root, name))
+        os.rmdir(root)
@@ -0,0 +1,109 @@
+"""
+Manifest of the stamped outputs in a target directory.
+
+Each completed output is appended to a JSON-lines journal as soon as it is written,
+so a rerun (or a run resumed after a crash) only stamps new or changed submissions.
+The journal is compacted at the end of every run.
+"""
+
+import hashlib
+import json
+import os
+import os.path as osp
+
+MANIFEST = "manifest.jsonl"
+CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while chunk := fd.read(CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Manifest:
+    def __init__(self, tgt_dir: str, hash_sources: bool = False):
+        """
+        Args:
+            tgt_dir: directory of the stamped outputs holding the manifest
+            hash_sources: compare sources by content hash instead of size and mtime
+        """
+        self.tgt_dir = tgt_dir
+        self.path = osp.join(tgt_dir, MANIFEST)
+        self.hash_sources = hash_sources
+        self.entries: dict[str, dict] = {}  # output name: signature
+        if osp.exists(self.path):
+            with open(self.path, encoding="utf-8") as fd:
+                for line in fd:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn write of an interrupted run
+                    output = record.pop("output")
+                    if record.get("deleted"):
+                        self.entries.pop(output, None)
+                    else:
+                        self.entries[output] = record
+
+    def signature(self, src: str, **stamp) -> dict:
+        """
+        Signature of an output stamped from `src`, `stamp` holds everything else affecting it
+        (content, extra, fonts, ...). It should be JSON serializable.
+        """
+        st = os.stat(src)
+        sig = {"src": src, "size": st.st_size}
+        if self.hash_sources:
+            sig["sha256"] = file_digest(src)
+        else:
+            sig["mtime_ns"] = st.st_mtime_ns
+        sig.update(stamp)
+        # the same representation as loaded from the journal
+        return json.loads(json.dumps(sig))
+
+    def unchanged(self, src: str, sig: dict) -> bool:
+        """whether `src` is still the file `sig` was taken of, e.g. after stamping it"""
+        try:
+            st = os.stat(src)
+        except FileNotFoundError:
+            return False
+        if st.st_size != sig["size"]:
+            return False
+        if self.hash_sources:
+            return file_digest(src) == sig["sha256"]
+        return st.st_mtime_ns == sig["mtime_ns"]
+
+    def is_current(self, output: str, sig: dict) -> bool:
+        return self.entries.get(output) == sig and osp.exists(osp.join(self.tgt_dir, output))
+
+    def _append(self, record: dict):
+        with open(self.path, "a", encoding="utf-8") as fd:
+            fd.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def record(self, output: str, sig: dict):
+        self.entries[output] = sig
+        self._append({"output": output, **sig})
+
+    def remove_stale(self, outputs: set[str]) -> list[str]:
+        """
+        Delete the recorded outputs which are not expected anymore (e.g. renamed with a new score).
+        Returns:
+            the deleted output names
+        """
+        stale = sorted(set(self.entries) - outputs)
+        for output in stale:
+            path = osp.join(self.tgt_dir, output)
+            if osp.exists(path):
+                os.remove(path)
+            del self.entries[output]
+            self._append({"output": output, "deleted": True})
+        return stale
+
+    def compact(self):
+        """rewrite the journal with the latest entry of each output"""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fd:
+            for output in sorted(self.entries):
+                fd.write(json.dumps({"output": output, **self.entries[output]}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
@@ -0,0 +1,101 @@
+"""
+Marker for Jupyter notebook submissions.
+
+A markdown cell with the score and the reasons is inserted at the top of the notebook.
+The notebook is memory-mapped and only scanned up to the top-level "cells" array,
+the rest (e.g. base64 outputs) is written through without being decoded or copied.
+"""
+
+import json
+import mmap
+import re
+import uuid
+from contextlib import nullcontext
+from typing import BinaryIO, Optional
+
+from logger import metrics
+
+# complete strings (which may hold escaped quotes) or structural characters
+TOKEN_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]:,]', re.DOTALL)
+MINOR_RE = re.compile(rb'"nbformat_minor"\s*:\s*(\d+)')
+WHITESPACE_RE = re.compile(rb"\s*")
+TAIL_SIZE = 4096
+CELL_ID_MINOR = 5  # cell ids are required since nbformat 4.5
+
+BRACE_OPEN, BRACKET_OPEN = ord("{"), ord("[")
+BRACE_CLOSE, BRACKET_CLOSE = ord("}"), ord("]")
+QUOTE, COMMA = ord('"'), ord(",")
+
+
+def find_cells(nb) -> int:
+    """
+    Locate the top-level "cells" array of a notebook.
+    Args:
+        nb: bytes-like notebook content, e.g. a mmap
+    Returns:
+        the offset right after the opening bracket of the array
+    Raises:
+        ValueError: no top-level cells array
+    """
+    depth, expect_key, key = 0, False, None
+    for m in TOKEN_RE.finditer(nb):
+        c = nb[m.start()]
+        if c == QUOTE:
+            if depth == 1 and expect_key:
+                key = m.group()
+        elif c in (BRACE_OPEN, BRACKET_OPEN):
+            if depth == 1 and c == BRACKET_OPEN and key == b'"cells"' and not expect_key:
+                return m.end()
+            depth += 1
+            if depth == 1:
+                expect_key = True
+        elif c in (BRACE_CLOSE, BRACKET_CLOSE):
+            depth -= 1
+        elif depth == 1:
+            expect_key = c == COMMA
+    raise ValueError("no top-level cells array found")
+
+
+def get_nbformat_minor(nb) -> Optional[int]:
+    # nbformat sorts the top-level keys, so nbformat_minor is at the end of the file
+    found = MINOR_RE.search(nb, max(0, len(nb) - TAIL_SIZE)) or MINOR_RE.search(nb)
+    return int(found.group(1)) if found else None
+
+
+def make_score_cell(content: str, extra: Optional[str] = None, with_id: bool = False) -> dict:
+    source = [f"## {content}\n"]
+    if extra:
+        source.append("\n")
+        source.extend(f"- {line}\n" for line in extra.split("\n"))
+    source[-1] = source[-1].rstrip("\n")  # the last line goes without newline as jupyter does
+    cell = {"cell_type": "markdown", "metadata": {}, "source": source}
+    if with_id:
+        cell["id"] = uuid.uuid4().hex[:8]
+    return cell
+
+
+def mark_notebook_task(src_nb: str, content: str, out_nb: str | BinaryIO, extra: Optional[str] = None):
+    """
+    Args:
+        src_nb: str, input notebook file name
+        content: str, score to be written
+        out_nb: str, output notebook file name or a binary stream
+        extra: reasons, one per line
+    """
+    with open(src_nb, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as nb:
+        with metrics.stage("scan"):
+            pos = find_cells(nb)
+        minor = get_nbformat_minor(nb)
+        cell = json.dumps(
+            make_score_cell(content, extra, minor is not None and minor >= CELL_ID_MINOR),
+            ensure_ascii=False,
+        ).encode()
+        empty = nb[WHITESPACE_RE.match(nb, pos).end()] == BRACKET_CLOSE
+        with (
+            metrics.stage("write"),
+            open(out_nb, "wb") if isinstance(out_nb, str) else nullcontext(out_nb) as out,
+            memoryview(nb) as view,
+        ):
+            out.write(view[:pos])
+            out.write(cell if empty else cell + b",")
+            out.write(view[pos:])
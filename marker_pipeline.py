@@ -0,0 +1,145 @@
+"""
+Pipelined marking in a single process.
+
+    prefetch (thread) -> loaded queue -> stamp (caller thread) -> stamped queue -> flush (thread)
+
+Source pdfs are read ahead and outputs are written behind the stamping, so the disk (or the
+network share) is kept busy while reportlab and pypdf compute. Both queues are bounded, a full
+queue blocks the stage before it, so at most about 2 * depth files are held in memory.
+Outputs are written to a temporary file next to the target and renamed into place.
+"""
+
+import os
+import queue
+import threading
+import time
+from io import BytesIO
+from typing import Iterator, Optional
+
+from logger import metrics
+from marker_base import mark_task
+from marker_notebook import mark_notebook_task
+from marker_zip import mark_zip_task
+
+DONE = None  # end of the queue
+
+
+def write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as fd:
+            fd.write(data)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _prefetch(jobs: list, loaded: queue.Queue):
+    """read the source pdfs ahead, zip and notebook submissions are read by their markers"""
+    for job in jobs:
+        data, err, start = None, None, time.perf_counter()
+        if job.src.endswith(".pdf"):
+            try:
+                with open(job.src, "rb") as fd:
+                    data = fd.read()
+            except Exception as e:
+                err = f"{type(e).__name__}: {e}"
+        loaded.put((job, data, err, time.perf_counter() - start))
+    loaded.put(DONE)
+
+
+def _flush(stamped: queue.Queue, done: queue.Queue):
+    """write the outputs, every item gets a result in `done` even if it fails"""
+    while (item := stamped.get()) is not DONE:
+        i, job, output, err, timings = item
+        if err is None:
+            start = time.perf_counter()
+            try:
+                write_atomic(job.tgt, output.getbuffer())
+            except Exception as e:  # the writer keeps going for the rest of the files
+                err = f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - start
+            timings["stages"]["flush"] = elapsed
+            timings["seconds"] += elapsed
+        done.put((i, err, timings))
+
+
+def _stamp(job, data: Optional[bytes], sign_pdf, incremental, cache, zip_pattern) -> BytesIO:
+    output = BytesIO()
+    if job.src.endswith(".zip"):
+        mark_zip_task(
+            job.src, job.content, sign_pdf, output, job.extra,
+            pattern=zip_pattern, incremental=incremental, cache=cache,
+        )
+    elif job.src.endswith(".ipynb"):
+        mark_notebook_task(job.src, job.content, output, job.extra)
+    else:
+        mark_task(
+            BytesIO(data), job.content, sign_pdf, output, job.extra,
+            incremental=incremental, cache=cache, annotations=job.annotations,
+        )
+    return output
+
+
+def pipelined_marker(
+    jobs: list,
+    depth: int = 4,
+    sign_pdf: Optional[str] = None,
+    incremental: bool = False,
+    cache=None,
+    zip_pattern: str = "*.pdf",
+) -> Iterator[tuple[Optional[str], dict]]:
+    """
+    Mark `jobs` (see marker_common.MarkJob) in a pipeline.
+    Args:
+        depth: capacity of each queue between the stages
+        sign_pdf: signature file of the process, removed at the end. None to keep signatures in memory.
+    Returns:
+        (error message or None, timings) of each job in the order of `jobs`, as they are written
+    """
+    assert depth > 0, f"depth should be positive, got {depth}"
+    loaded, stamped, done = queue.Queue(depth), queue.Queue(depth), queue.Queue()
+    # daemon threads, so an interrupted run is not kept alive by a blocked stage
+    threading.Thread(target=_prefetch, args=(jobs, loaded), daemon=True).start()
+    writer = threading.Thread(target=_flush, args=(stamped, done), daemon=True)
+    writer.start()
+
+    results, pending = {}, 0
+
+    def ready() -> Iterator[tuple[Optional[str], dict]]:
+        nonlocal pending
+        while True:
+            try:
+                i, err, timings = done.get_nowait()
+                results[i] = (err, timings)
+            except queue.Empty:
+                break
+        while pending in results:
+            yield results.pop(pending)
+            pending += 1
+
+    try:
+        i = 0
+        while (item := loaded.get()) is not DONE:
+            job, data, err, read_seconds = item
+            output = None
+            with metrics.track_file(job.src) as timings:
+                if err is None:
+                    try:
+                        output = _stamp(job, data, sign_pdf, incremental, cache, zip_pattern)
+                    except Exception as e:
+                        err = f"{type(e).__name__}: {e}"
+            if job.src.endswith(".pdf"):
+                timings["stages"]["prefetch"] = read_seconds
+                timings["seconds"] += read_seconds
+            stamped.put((i, job, output, err, timings))  # blocks while the writer is behind
+            i += 1
+            yield from ready()
+
+        stamped.put(DONE)
+        writer.join()
+        yield from ready()
+    finally:
+        if sign_pdf and os.path.exists(sign_pdf):  # the signature file of this process
+            os.remove(sign_pdf)
@@ -0,0 +1,111 @@
+"""
+Watch a task directory and mark submissions as soon as they are renamed with a score.
+
+The directory is polled with `os.scandir` snapshots, or waited on with inotify if
+inotify_simple (pip install inotify_simple) is available. Once a change is seen, the marker
+waits until the snapshots settle so a burst of renames is marked in one run, and the manifest
+of the run leaves the submissions which are already up to date untouched.
+"""
+
+import os
+import time
+from typing import Callable, Optional
+
+from logger import get_default_logger
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # polling only
+    INotify = None
+
+logger = get_default_logger()
+
+Snapshot = dict[str, tuple[int, int]]  # file name: (size, mtime_ns)
+
+
+def snapshot(src_dir: str, exts: tuple[str, ...] = (".pdf", ".zip", ".ipynb")) -> Snapshot:
+    """scored submissions (sid-name-task-score.ext) of `src_dir`"""
+    snap = {}
+    with os.scandir(src_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(exts) or entry.name.count("-") != 3:
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:  # renamed meanwhile
+                continue
+            snap[entry.name] = (st.st_size, st.st_mtime_ns)
+    return snap
+
+
+class Watcher:
+    def __init__(self, src_dir: str, interval: float = 1.0, use_inotify: bool = True):
+        """
+        Args:
+            interval: seconds between snapshots when polling, and the timeout of inotify
+            use_inotify: wait on inotify if inotify_simple is installed
+        """
+        self.src_dir = src_dir
+        self.interval = interval
+        self.inotify = None
+        if use_inotify and INotify is not None:
+            self.inotify = INotify()
+            self.inotify.add_watch(
+                src_dir,
+                flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE,
+            )
+        self.last = snapshot(src_dir)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def wait(self) -> Snapshot:
+        """block until the scored submissions differ from the last snapshot"""
+        while True:
+            if self.inotify is not None:
+                self.inotify.read(timeout=int(self.interval * 1000))
+            else:
+                time.sleep(self.interval)
+            snap = snapshot(self.src_dir)
+            if snap != self.last:
+                return snap
+
+    def settle(self, snap: Snapshot, debounce: float) -> Snapshot:
+        """wait until the snapshot stays the same for `debounce` seconds"""
+        while True:
+            time.sleep(debounce)
+            latest = snapshot(self.src_dir)
+            if latest == snap:
+                self.last = latest
+                return latest
+            snap = latest
+
+
+def watch_marker(
+    src_dir: str,
+    marker: Callable[[], None],
+    interval: float = 1.0,
+    debounce: float = 2.0,
+    use_inotify: bool = True,
+    rounds: Optional[int] = None,
+):
+    """
+    Run `marker` once and again after every settled change of the scored submissions in `src_dir`.
+    Args:
+        rounds: number of changes to mark before returning, None to watch until interrupted
+    """
+    watcher = Watcher(src_dir, interval, use_inotify)
+    logger.info(f"Watching {src_dir} with {'inotify' if watcher.inotify else 'polling'}, Ctrl-C to stop")
+    try:
+        marker()
+        done = 0
+        while rounds is None or done < rounds:
+            snap = watcher.settle(watcher.wait(), debounce)
+            logger.info(f"{len(snap)} scored submissions in {src_dir}")
+            marker()
+            done += 1
+    except KeyboardInterrupt:
+        logger.info(f"Stopped watching {src_dir}")
+    finally:
+        watcher.close()
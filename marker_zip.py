@@ -0,0 +1,118 @@
+"""
+Marker for ZIP submissions.
+
+Report pdfs inside an archive are stamped in memory and written to a new archive,
+every other member is copied through with its compressed bytes as they are.
+"""
+
+import fnmatch
+import struct
+import zipfile
+from io import BytesIO
+from typing import BinaryIO, Optional
+
+from logger import metrics
+from marker_base import mark_task
+from marker_cache import OverlayCache
+
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_FLAG = 0x08
+ZIP64_EXTRA_ID = 0x0001
+IGNORED_PREFIX = "__MACOSX/"  # resource forks archived by macOS
+
+
+def _strip_zip64(extra: bytes) -> bytes:
+    """drop the zip64 extra field, ZipInfo.FileHeader writes its own one when it is required"""
+    kept, i = [], 0
+    while i + 4 <= len(extra):
+        xid, size = struct.unpack("<HH", extra[i : i + 4])
+        if xid != ZIP64_EXTRA_ID:
+            kept.append(extra[i : i + 4 + size])
+        i += 4 + size
+    return b"".join(kept)
+
+
+def copy_member_raw(src_fp, dst: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """
+    Copy a member of the archive opened as `src_fp` into `dst` without decompressing it.
+    zipfile has no public API for it, so the local header is written through `dst.fp`
+    and the member is registered the same way `ZipFile.write` does.
+    """
+    src_fp.seek(info.header_offset)
+    header = src_fp.read(zipfile.sizeFileHeader)
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"Bad local header of {info.filename}")
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    src_fp.seek(name_len + extra_len, 1)
+
+    copied = zipfile.ZipInfo(info.filename, info.date_time)
+    for attr in (
+        "compress_type", "comment", "create_system", "create_version", "extract_version",
+        "external_attr", "internal_attr", "CRC", "compress_size", "file_size",
+    ):
+        setattr(copied, attr, getattr(info, attr))
+    # sizes are known, so they go into the local header instead of a data descriptor
+    copied.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    copied.extra = _strip_zip64(info.extra)
+    copied.header_offset = dst.fp.tell()
+    dst.fp.write(copied.FileHeader())
+    remain = info.compress_size
+    while remain > 0:
+        chunk = src_fp.read(min(remain, 1 << 20))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data of {info.filename}")
+        dst.fp.write(chunk)
+        remain -= len(chunk)
+    dst.filelist.append(copied)
+    dst.NameToInfo[copied.filename] = copied
+    dst.start_dir = dst.fp.tell()
+
+
+def is_report(info: zipfile.ZipInfo, pattern: str) -> bool:
+    if info.is_dir() or info.filename.startswith(IGNORED_PREFIX):
+        return False
+    return fnmatch.fnmatch(info.filename.lower(), pattern.lower())
+
+
+def mark_zip_task(
+    src_zip: str,
+    content: str,
+    sign_pdf: Optional[str],
+    out_zip: str | BinaryIO,
+    extra: Optional[str] = None,
+    pattern: str = "*.pdf",
+    incremental: bool = False,
+    cache: Optional[OverlayCache] = None,
+) -> list[str]:
+    """
+    Args:
+        src_zip: str, input zip file name
+        content: str, content to be signed
+        out_zip: str, output zip file name or a seekable binary stream
+        pattern: glob pattern (case insensitive) of the report pdfs in the archive
+    Returns:
+        names of the stamped members
+    Raises:
+        ValueError: no member matches the pattern
+    """
+    with zipfile.ZipFile(src_zip) as zin:
+        reports = {info.filename for info in zin.infolist() if is_report(info, pattern)}
+        if not reports:
+            raise ValueError(f"no report matches {pattern} in {src_zip}")
+        with open(src_zip, "rb") as raw, zipfile.ZipFile(out_zip, "w") as zout:
+            for info in zin.infolist():
+                if info.filename not in reports:
+                    with metrics.stage("copy"):
+                        copy_member_raw(raw, zout, info)
+                    continue
+                marked = BytesIO()
+                mark_task(
+                    BytesIO(zin.read(info)), content, sign_pdf, marked, extra,
+                    incremental=incremental, cache=cache,
+                )
+                stamped = zipfile.ZipInfo(info.filename, info.date_time)
+                stamped.compress_type = info.compress_type
+                stamped.external_attr = info.external_attr
+                stamped.comment = info.comment
+                zout.writestr(stamped, marked.getvalue())
+    return sorted(reports)
@@ -1,11 +1,16 @@
+import csv
 import os
 import os.path as osp
-from pathlib import Path
-from typing import Callable
+import re
+from typing import Callable, Optional
 
 import fire
 
-from header import PROVIDER_HEADER, SCORE_HEADER, SUBMIT_HEADER
+from header import PROVIDER_HEADER, SCORE_HEADER, SIGNIN_HEADER, SUBMIT_HEADER
+from indexer import SID_PATTERN, Submission, get_index
+from roster import load_roster
+
+SID_RE = re.compile(SID_PATTERN)
 
 def get_sid(name: str) -> str:
     """
@@ -15,95 +20,116 @@ def get_sid(name: str) -> str:
     Returns:
         the sid of the submission
     """
-    loc = name.find("202")
-    assert loc != -1, f"{name} does not contain SID"
-    return name[loc:loc+13] # 4+5+4
+    found = SID_RE.search(name)
+    assert found is not None, f"{name} does not contain SID"
+    return found.group()
 
-def __dir_walker(path: str, output: str, header: str, processor: Callable[[str], str]):
+def __dir_walker(path: str, output: str, header: str, processor: Callable[[Submission], tuple]) -> list[tuple]:
     """
     walk through the directory and process each file ignoring csv and directory
     Args:
         path: the directory to walk through
         output: the output file name
         header: the header of the output csv file
-        processor: a function to process each file based filename
+        processor: a function to process each file into a row based on its parsed filename
+    Returns:
+        the rows written
     """
-    content = []
-    for file in os.listdir(path):
-        if file.endswith("csv") or osp.isdir(osp.join(path, file)):
-            continue
-        content.append(processor(file))
-    with open(osp.join(path, output), "w", encoding="utf-8-sig") as fd:
-        write_content = "\n".join(content)
-        fd.write(f"{header}\n{write_content}")
+    rows = [processor(sub) for sub in get_index(path)]
+    with open(osp.join(path, output), "w", encoding="utf-8-sig", newline="") as fd:
+        fd.write(header + "\n")
+        csv.writer(fd, lineterminator="\n").writerows(rows)  # fields with commas are quoted
+    return rows
+
+
+def __save_task(db: Optional[str], table: str, path: str, rows: list[tuple]):
+    """replace the records of the task in the gradebook `db` if given"""
+    if db is None:
+        return
+    from gradebook import Gradebook, task_name
+
+    with Gradebook(db) as gb:
+        gb.put_task(table, task_name(path), rows)
 
 
 def submission_record(path: str, output: str = "provider.csv"):
     # content = [ file.split('-')[1] for file in os.listdir(path) if not file.endswith("csv") ]
-    def proc(name: str):
-        parts = name.split("-")
+    def proc(sub: Submission):
+        parts = sub.fields
         assert (
             len(parts) == 3 or len(parts) == 4
-        ), f"{name}:{len(parts)} fatal format error"
-        return parts[0] + "," + parts[1]
+        ), f"{sub.filename}:{len(parts)} fatal format error"
+        return parts[0], parts[1]
 
     __dir_walker(path, output, PROVIDER_HEADER, proc)
 
 
-def submission_grades(path: str, output: str = "grades.csv"):
-    """submission score writer"""
+def submission_grades(path: str, output: str = "grades.csv", db: Optional[str] = None):
+    """
+    submission score writer
+    Args:
+        db: SQLite gradebook to write the scores of the task into
+    """
 
-    def proc(name: str):
-        n, _ = name.split(".")
-        parts = n.split("-")
-        assert len(parts) == 4, f"{name}:{len(parts)} fatal format error"
-        return parts[0] + "," + parts[1] + "," + parts[3]
+    def proc(sub: Submission):
+        parts = sub.fields
+        assert len(parts) == 4, f"{sub.filename}:{len(parts)} fatal format error"
+        return parts[0], parts[1], parts[3]
 
-    __dir_walker(path, output, SCORE_HEADER, proc)
+    rows = __dir_walker(path, output, SCORE_HEADER, proc)
+    __save_task(db, "scores", path, [(sid, name, int(score)) for sid, name, score in rows])
 
 
-def submission_backup(path: str, output: str = "submission.csv"):
-    def proc(name: str):
-        LEN_ID = 13
-        n, ext = name.split(".", 1)
-        sid_idx = n.find("20")  # find it easilier to locate sid prefix
+def submission_backup(path: str, output: str = "submission.csv", db: Optional[str] = None):
+    def proc(sub: Submission):
         # no match failure process here. All failed cases should be handled by submission_check
-        sid = n[sid_idx : sid_idx + LEN_ID]
-        if n.count("-") == 3:
-            ld = n.rindex("-")
-            n = n[:ld]
-        assert sid.isnumeric(), f"SID:{sid} should be numeric"
-        return f"{sid},{ext},{n}"
+        assert sub.sid is not None, f"{sub.filename} does not contain SID"
+        n = sub.stem
+        if len(sub.fields) == 4:
+            n = n[: n.rindex("-")]
+        return sub.sid, sub.ext, n
 
-    __dir_walker(path, output, SUBMIT_HEADER, proc)
+    rows = __dir_walker(path, output, SUBMIT_HEADER, proc)
+    __save_task(db, "submissions", path, rows)
 
 
-def backup(path: str, backup: str = "submission.csv"):
-    # the recorder is partial csv of backup file
-    # but it remains until better solution is found
+def backup(
+    path: str, backup: str = "submission.csv", db: Optional[str] = None,
+    snapshot: bool = True, store: str = ".snapshots", jobs: int = 4, hardlink: bool = False,
+):
+    """
+    backup submission files before manual modification
+    Args:
+        backup: csv of the submission file names
+        snapshot: also snapshot the files into the content-addressed `store`, see snapshot.py
+        jobs: number of threads to hash and store files with
+        hardlink: store the snapshot objects as hardlinks where reflinks are not supported, which
+            saves space but lets an in-place edit of a submission reach its object
+    """
     check_result = submission_check(path)
     if not check_result:
         print("Submission check failed, please make sure each submission comes with SID")
         return
-    submission_backup(path, backup)
+    submission_backup(path, backup, db)
+    if snapshot:
+        from snapshot import take_snapshot
+
+        take_snapshot(path, store, jobs, hardlink)
     # submission_record(path, provider)
 
 def submission_check(path: str) -> bool:
     """check submission file name and format"""
     count, nosid = 0, 0
-    for file in os.listdir(path):
-        if file.endswith("csv"):
-            continue
-        part_count = file.count('-')
-        if file.find("20") == -1:
+    for sub in get_index(path):
+        file, ext = sub.filename, sub.ext
+        if sub.sid is None:
             print(f"{file} does not contain SID")
             nosid += 1
             continue
-        if part_count not in [3, 2]:
+        if len(sub.fields) not in [4, 3]:
             print(f"{file} may use diff separator instead of '-'")
             count += 1
             continue
-        _, ext = file.split(".", 1)
         if ext.lower() not in ["zip", "pdf", "ipynb"]:
             print(f"{file}:[{ext}] uses unexpected file extension")
             count += 1
@@ -112,106 +138,88 @@ def submission_check(path: str) -> bool:
     return nosid == 0
 
 def submission_info_by_roster(sub: str, roster: str="names.csv"):
-    with open(roster, "r", encoding="utf-8-sig") as fd:
-        lines = fd.read().splitlines()[1:]
-    rd, rl = {}, []
-    for line in lines:
-        seq, sid, name, _ = line.split(",", 3)
-        rl.append(sid)
-        rd[sid] = name
-    nameset = set(rl)
+    rs = load_roster(roster)
 
-    with open(sub, "r", encoding="utf-8-sig") as fd:
-        lines = fd.read().splitlines()[1:]
-    subset = set(line.split(",")[0] for line in lines)
+    with open(sub, "r", encoding="utf-8-sig", newline="") as fd:
+        rows = list(csv.reader(fd))[1:]
+    subset = set(row[0] for row in rows if row)
 
-    print(f"Total {len(subset)} submissions found, {len(nameset)} students in roster")
+    print(f"Total {len(subset)} submissions found, {len(rs)} students in roster")
 
-    nein = nameset - subset
-    ja = subset - nameset
+    nein = rs.missing(subset)
+    ja = rs.unknown(subset)
 
     for sid in nein:
-        print(f"{rd[sid]} does not submit yet")
+        print(f"{rs.name(sid)} does not submit yet")
 
     for sid in ja:
         print(f"{sid} is unkown, but already submit")
 
+def session_key(name: str) -> list:
+    """natural order of session folders, e.g. week2 before week10"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
 def signin_info_by_roster(
         sub: str, signin: str="signin", record: str="signer.csv",
         roster: str="names.csv"):
-
-    with open(roster, "r", encoding="utf-8-sig") as fd:
-        lines = fd.read().splitlines()[1:]
-    sgn, rd, rl = {}, {}, []
-    for line in lines:
-        seq, sid, name, _ = line.split(",", 3)
-        rl.append(sid)
-        rd[sid] = False
-
-    src_fld = Path(sub)
-    folders = [f for f in src_fld.iterdir() if f.is_dir()]
-    for fld in folders:
-        signin_folder = fld/signin
-        if not signin_folder.is_dir(): continue
-        for k in rd: # rd clear
-            rd[k] = False
-        for file in signin_folder.iterdir():
-            if (not file.is_file()) or file.suffix == "csv": continue
-            try:
-                sid = get_sid(file.name)
-                assert sid in rd, f"{file.name} SID not found in roster"
-                rd[sid] = True
-            except AssertionError:
-                print(f"{file.name} needs manual check")
-        sgn[fld.name] = rd.copy()
-
-    with open(record, "w", encoding="utf-8-sig") as fd:
-        # TODO
-        pass
+    """
+    Attendance of the roster over the sessions, i.e. folders of `sub` with a `signin` folder.
+    Each signin folder is scanned once into a column of a students x sessions boolean matrix.
+    Args:
+        record: the attendance of each session, the count and the rate of each student
+    """
+    import numpy as np  # only the attendance needs numpy, keep the other commands light
+
+    rs = load_roster(roster)
+    with os.scandir(sub) as it:
+        sessions = sorted(
+            (entry.name for entry in it if entry.is_dir() and osp.isdir(osp.join(entry.path, signin))),
+            key=session_key,
+        )
+    attended = np.zeros((len(rs), len(sessions)), dtype=bool)
+    for col, session in enumerate(sessions):
+        for f in get_index(osp.join(sub, session, signin)):
+            row = rs.index.get(f.sid)
+            if row is None:
+                print(f"{session}/{f.filename} needs manual check")
+                continue
+            attended[row, col] = True
+
+    counts = attended.sum(axis=1)
+    rates = counts / max(len(sessions), 1) * 100
+    header = SIGNIN_HEADER.format(",".join(sessions))
+    rows = [
+        (sid, name, *row.view(np.uint8), cnt, f"{rate:.1f}")
+        for sid, name, row, cnt, rate in zip(rs.sids, rs.names, attended, counts, rates)
+    ]
+    with open(record, "w", encoding="utf-8-sig", newline="") as fd:
+        fd.write(header + "\n")
+        csv.writer(fd, lineterminator="\n").writerows(rows)  # names with commas are quoted
+
+    print(f"Total {len(sessions)} sessions, {len(rs)} students in roster")
+    for session, cnt in zip(sessions, attended.sum(axis=0)):
+        print(f"{session}: {cnt}/{len(rs)} signed in")
 
 def get_sid_from_folder(sub: str) -> list:
-    files = os.listdir(sub)
-    fl = []
-    for f in files:
-        fn = osp.join(sub, f)
-        if (not osp.isfile(fn)) or fn.endswith(".csv"): continue
-        try:
-            fl.append(get_sid(f))
-        except AssertionError:
-            print(f"{f} needs manual check")
+    index = get_index(sub)
+    for f in index:
+        if f.sid is None:
+            print(f"{f.filename} needs manual check")
 
     # sort sid by integer value
-    return sorted(fl, key=lambda x: int(x))
+    return index.sids()
 
 
 def get_unchecked_sid(sub: str, roster: str="names.csv") -> list:
-    with open(roster, "r", encoding="utf-8-sig") as fd:
-        lines = fd.read().splitlines()[1:]
-    rd, rl = {}, []
-    for line in lines:
-        seq, sid, name, _ = line.split(",", 3)
-        rl.append(sid)
-    nameset = set(rl)
-
-    subset = set(get_sid_from_folder(sub))
-
-    diffset = nameset - subset
-    return sorted(list(diffset), key=lambda x: int(x))
+    diffset = load_roster(roster).missing(get_sid_from_folder(sub))
+    return sorted(diffset, key=lambda x: int(x))
 
 def get_sid_from_roster(roster: str="names.csv") -> list:
-    with open(roster, "r", encoding="utf-8-sig") as fd:
-        lines = fd.read().splitlines()[1:]
-    rl = []
-    for line in lines:
-        seq, sid, name, _ = line.split(",", 3)
-        rl.append(sid)
-    return rl
+    return list(load_roster(roster).sids)
 
 def get_sid_diff(sub: str, roster: str="names.csv"):
-    roster = get_sid_from_roster(roster)
-    sub = get_sid_from_folder(sub)
-    diff = set(roster) - set(sub)
-    subs = sorted(list(diff), key=lambda x: int(x))
+    subs = get_unchecked_sid(sub, roster)
     for sid in subs:
         print(f"{sid} is not in submission folder")
 
@@ -223,5 +231,6 @@ if __name__ == "__main__":
             "check": submission_check,  # check submission file name and format
             "diff": submission_info_by_roster,  # check submission diff with roster
             "diff_cwd": get_sid_diff,
+            "signin": signin_info_by_roster,  # attendance of the sign-in sessions
         }
     )
@@ -1,28 +1,45 @@
+import csv
+import os.path as osp
+from typing import Optional
+
 import fire
 
+from roster import load_roster
+
+
+def rebase_deduction_on_roster(deduction: str, roster: str, output: str, db: Optional[str] = None):
+    """
+    Export a deductions table with a complete list based on the list and points deducted.
+    Args:
+        db: SQLite gradebook to merge the roster and the deductions of the task (directory of `deduction`) into
+    """
+    mapper = load_roster(roster)
+
+    with open(deduction, encoding="utf-8-sig", newline="") as ded:
+        rows = csv.reader(ded)
+        header = next(rows)
+        records = {row[0]: row for row in rows if row}  # sid, name, reason[, delta]
+
+    with open(output, "w", encoding="utf-8-sig", newline="") as writer:
+        out = csv.writer(writer, lineterminator="\n")
+        out.writerow(header)
+        for k, name in zip(mapper.sids, mapper.names):
+            record = records.get(k)
+            out.writerow([k, name, *(record[2:] if record else [""] * (len(header) - 2))])
+
+    if db is not None:
+        from gradebook import Gradebook, task_name
 
-def rebase_deduction_on_roster(deduction: str, roster: str, output: str):
-    """Export a deductions table with a complete list based on the list and points deducted."""
-    with open(roster, encoding="utf-8-sig") as caller:
-        content = caller.readlines()
-
-    mapper = {}
-    for line in content[1:]:
-        sid, name = line.strip().split(",")
-        mapper[sid] = name
-
-    with open(deduction, encoding="utf-8-sig") as ded:
-        content = ded.readlines()
-    reasoner = {}
-    header = content[0]
-    for line in content[1:]:
-        sid, _, reason = line.strip().split(",")
-        reasoner[sid] = reason
-
-    with open(output, "w", encoding="utf-8-sig") as writer:
-        writer.write(header)
-        for k in mapper:
-            writer.write(f"{k},{mapper[k]},{reasoner.get(k, '')}\n")
+        with Gradebook(db) as gb:
+            gb.put_roster(mapper)
+            # merged, so the deltas written by pregrade are kept for files without them
+            gb.merge_task(
+                "deductions", task_name(osp.dirname(osp.abspath(deduction))),
+                [
+                    (sid, mapper.name(sid, row[1]), row[2], int(row[3]) if len(row) > 3 and row[3] else None)
+                    for sid, row in records.items()
+                ],
+            )
 
 
 if __name__ == "__main__":
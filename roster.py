@@ -0,0 +1,94 @@
+"""
+Roster loader shared by all commands.
+
+Two layouts are accepted:
+- seq,sid,name[,...] (e.g. names.csv exported by the academic system)
+- sid,name
+
+A roster is parsed once per file and kept until the file is modified.
+"""
+
+import csv
+import os
+import os.path as osp
+from array import array
+from typing import Iterable, Optional
+
+
+class Roster:
+    def __init__(self, sids: list[str], names: list[str], seqs: array):
+        self.sids = sids
+        self.names = names
+        self.seqs = seqs  # -1 for rosters without seq
+        self.index = {sid: i for i, sid in enumerate(sids)}  # sid: row
+
+    def __len__(self):
+        return len(self.sids)
+
+    def __contains__(self, sid: str):
+        return sid in self.index
+
+    def __iter__(self):
+        return iter(self.sids)
+
+    def name(self, sid: str, default: Optional[str] = None) -> Optional[str]:
+        row = self.index.get(sid)
+        return default if row is None else self.names[row]
+
+    def missing(self, sids: Iterable[str]) -> list[str]:
+        """SIDs of the roster not in `sids`, in roster order"""
+        found = set(sids)
+        return [sid for sid in self.sids if sid not in found]
+
+    def unknown(self, sids: Iterable[str]) -> list[str]:
+        """SIDs of `sids` not in the roster"""
+        return [sid for sid in sids if sid not in self.index]
+
+
+def parse_roster(path: str) -> Roster:
+    sids, names, seqs = [], [], array("l")
+    with open(path, encoding="utf-8-sig", newline="") as fd:
+        rows = csv.reader(fd)
+        next(rows, None)  # header
+        for cols in rows:
+            cols = [col.strip() for col in cols]
+            if not any(cols):
+                continue
+            if len(cols) == 2:
+                sid, name = cols
+                seq = -1
+            else:
+                seq, sid, name = cols[:3]
+                seq = int(seq) if seq.isdigit() else -1
+            sids.append(sid)
+            names.append(name)
+            seqs.append(seq)
+    return Roster(sids, names, seqs)
+
+
+def merge_rosters(rosters: list[Roster]) -> Roster:
+    """concatenate rosters (e.g. several sections), the first row of a SID wins"""
+    sids, names, seqs = [], [], array("l")
+    seen = set()
+    for roster in rosters:
+        for sid, name, seq in zip(roster.sids, roster.names, roster.seqs):
+            if sid in seen:
+                continue
+            seen.add(sid)
+            sids.append(sid)
+            names.append(name)
+            seqs.append(seq)
+    return Roster(sids, names, seqs)
+
+
+_rosters: dict[str, tuple[int, Roster]] = {}
+
+
+def load_roster(path: str = "names.csv") -> Roster:
+    """roster of `path`, cached until the file is modified"""
+    key = osp.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _rosters.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = _rosters[key] = (mtime, parse_roster(path))
+    return cached[1]
@@ -0,0 +1,190 @@
+"""
+Content-addressed snapshots of task folders.
+
+    <store>/objects/<sha256[:2]>/<sha256>   content of the submissions, stored once
+    <store>/snapshots/<task>-<time>.json    file name: sha256 of a task folder at a time
+
+Objects are reflinked (copy-on-write clones) where the filesystem supports it and copied in
+parallel otherwise, so an in-place edit of a submission never reaches its object. Hardlinks are
+opt-in: they save the copies, but a hardlinked object shares its data with the submission, so
+an in-place edit would damage the snapshot too. Restores verify the hash of every object they use.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import fire
+
+from duper import hash_task
+from gradebook import task_name
+from indexer import get_index, invalidate
+from marker_manifest import file_digest
+
+STORE = ".snapshots"
+FICLONE = 0x40049409  # ioctl of linux/fs.h, clones a file on btrfs, xfs, ...
+
+
+def reflink(src: str, dst: str) -> bool:
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                raise
+    os.remove(dst)
+    return False
+
+
+def materialize(src: str, dst: str, hardlink: bool = False) -> str:
+    """
+    Put the content of `src` at `dst` (which must not exist) as cheaply as possible.
+    Returns:
+        how: "reflink", "hardlink" or "copy"
+    """
+    # unique per call, threads of the process may put the same object at once
+    fd, tmp = tempfile.mkstemp(prefix=f"{osp.basename(dst)}.", suffix=".tmp", dir=osp.dirname(dst))
+    os.close(fd)
+    try:
+        if reflink(src, tmp):  # removes `tmp` if it fails
+            how = "reflink"
+        else:
+            how = "copy"
+            if hardlink:
+                try:
+                    os.link(src, tmp)
+                    how = "hardlink"
+                except OSError:
+                    pass
+            if how == "copy":
+                shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if osp.exists(tmp):
+            os.remove(tmp)
+    return how
+
+
+class Store:
+    def __init__(self, root: str = STORE):
+        self.root = root
+        self.objects = osp.join(root, "objects")
+        self.snapshots = osp.join(root, "snapshots")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.snapshots, exist_ok=True)
+
+    def object_path(self, digest: str) -> str:
+        return osp.join(self.objects, digest[:2], digest)
+
+    def put(self, src: str, digest: str, hardlink: bool = False) -> Optional[str]:
+        """store `src` under `digest` unless it is stored already, returns how it is stored"""
+        dst = self.object_path(digest)
+        if osp.exists(dst) and osp.getsize(dst) == osp.getsize(src):
+            return None  # a truncated object (e.g. of a crashed run) is stored again
+        os.makedirs(osp.dirname(dst), exist_ok=True)
+        return materialize(src, dst, hardlink)
+
+    def list(self, task: Optional[str] = None) -> list[str]:
+        """snapshot names from the oldest, of `task` if given"""
+        names = sorted(f[: -len(".json")] for f in os.listdir(self.snapshots) if f.endswith(".json"))
+        return [n for n in names if task is None or n.rsplit("-", 2)[0] == task]
+
+    def load(self, name: str) -> dict:
+        with open(osp.join(self.snapshots, f"{name}.json"), encoding="utf-8") as fd:
+            return json.load(fd)
+
+    def save(self, name: str, snapshot: dict):
+        path = osp.join(self.snapshots, f"{name}.json")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fd:
+            json.dump(snapshot, fd, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+
+
+def take_snapshot(path: str, store: str = STORE, jobs: int = 4, hardlink: bool = False) -> str:
+    """
+    Snapshot the submissions of `path`, an unchanged folder reuses its latest snapshot.
+    Args:
+        hardlink: hardlink the objects to the submissions where reflinks are not supported instead
+            of copying them, an in-place edit of a submission then changes its object as well
+    Returns:
+        name of the snapshot
+    """
+    st = Store(store)
+    task = task_name(path)
+    files = {sub.filename: entry["sha256"] for sub, entry in hash_task(path, jobs=jobs)}
+    previous = st.list(task)
+    if previous and st.load(previous[-1])["files"] == files:
+        print(f"{path} is unchanged since snapshot {previous[-1]}")
+        return previous[-1]
+
+    # identical submissions are stored once, by the first of them
+    objects = {}
+    for filename, digest in files.items():
+        objects.setdefault(digest, filename)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        stored = list(pool.map(lambda item: st.put(osp.join(path, item[1]), item[0], hardlink), objects.items()))
+    name = f"{task}-{time.strftime('%Y%m%d-%H%M%S')}"
+    if name in previous:
+        name += f".{time.time_ns() % 10**9}"
+    st.save(name, {"task": task, "path": osp.abspath(path), "created": time.time(), "files": files})
+    hows = {how: stored.count(how) for how in ("reflink", "hardlink", "copy") if how in stored}
+    print(f"snapshot {name}: {len(files)} files, {len(files) - sum(hows.values())} stored already, new {hows}")
+    return name
+
+
+def list_snapshots(store: str = STORE, task: Optional[str] = None):
+    st = Store(store)
+    for name in st.list(task):
+        print(f"{name}: {len(st.load(name)['files'])} files")
+
+
+def restore_snapshot(
+    name: str, target: Optional[str] = None, store: str = STORE, prune: bool = False, hardlink: bool = False
+):
+    """
+    Restore the files of a snapshot under their original names.
+    Args:
+        name: snapshot name, see list_snapshots
+        target: folder to restore into, the snapshotted folder by default
+        prune: remove files of the folder not in the snapshot, e.g. submissions renamed after it
+        hardlink: hardlink restored files to the objects, copies are safer to edit
+    """
+    st = Store(store)
+    snapshot = st.load(name)
+    target = target or snapshot["path"]
+    os.makedirs(target, exist_ok=True)
+    restored = 0
+    for filename, digest in snapshot["files"].items():
+        dst = osp.join(target, filename)
+        if osp.exists(dst) and file_digest(dst) == digest:
+            continue
+        obj = st.object_path(digest)
+        if file_digest(obj) != digest:
+            raise ValueError(f"object of {filename} is corrupted, was the submission edited in place?")
+        if osp.exists(dst):
+            os.remove(dst)
+        materialize(obj, dst, hardlink)
+        restored += 1
+    removed = 0
+    if prune:
+        # the same files as indexed, csv files and hidden ones are kept
+        invalidate(target)
+        for sub in get_index(target):
+            if sub.filename not in snapshot["files"]:
+                os.remove(osp.join(target, sub.filename))
+                removed += 1
+    invalidate(target)
+    print(f"{restored} files restored, {removed} files removed in {target}")
+
+
+if __name__ == "__main__":
+    fire.Fire({"take": take_snapshot, "list": list_snapshots, "restore": restore_snapshot}, name="snapshot")
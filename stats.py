@@ -1,26 +1,44 @@
-from functools import reduce
+import csv
 import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import fire
 
 from header import STAT_HEADER
+from roster import Roster, load_roster, merge_rosters
 
 def get_submission_stats(
     path: str, reference: str
 ) -> tuple[dict[str, int], dict[str, str]]:
     ref = osp.join(path, reference)
     assert osp.exists(ref), f"file: {ref} doesn't exist. Generation grades file first"
-    with open(ref, encoding="utf-8-sig") as r:
-        content = r.readlines()[1:]
     grade_dict = {}  # sid:score
     sid_dict = {}  # sid:name
-    for line in content:
-        sid, name, score = line.strip().split(",")
-        grade_dict[sid] = int(score)
-        sid_dict[sid] = name
+    with open(ref, encoding="utf-8-sig", newline="") as r:
+        rows = csv.reader(r)
+        next(rows, None)  # header
+        for row in rows:
+            if not row:
+                continue
+            sid, name, score = row
+            grade_dict[sid] = int(score)
+            sid_dict[sid] = name
     return grade_dict, sid_dict
 
 
+def check_references(paths: list[str], reference: str):
+    """
+    Raises:
+        FileNotFoundError: listing every task without the reference file
+    """
+    missing = [p for p in paths if not osp.exists(osp.join(p, reference))]
+    if missing:
+        raise FileNotFoundError(
+            f"{reference} doesn't exist in {', '.join(missing)}. Generate grades files first"
+        )
+
+
 def submission_stats(path: str, reference: str = "grades.csv"):
     grade_dict, _ = get_submission_stats(path, reference)
     grades = list(grade_dict.values())
@@ -28,69 +46,160 @@ def submission_stats(path: str, reference: str = "grades.csv"):
 
 
 def get_roster_dict(file: str) -> dict[str, str]:
-    with open(file, encoding="utf-8-sig") as reader:
-        content = reader.readlines()[1:]
-    roster = {}  # sid:name
-    for line in content:
-        sid, name = line.strip().split(",")
-        roster[sid] = name
-    return roster
+    roster = load_roster(file)
+    return dict(zip(roster.sids, roster.names))  # sid:name
 
 
 def stringify_list(source: list, sep: str) -> str:
     return sep.join([str(it) for it in source])
 
 
+def load_gradebook_scores(paths: list[str], db: str) -> list[dict[str, int]]:
+    """
+    Raises:
+        LookupError: listing every task without scores in the gradebook
+    """
+    from gradebook import Gradebook, task_name
+
+    with Gradebook(db) as gb:
+        grades = [gb.scores(task_name(p)) for p in paths]
+    missing = [p for p, gd in zip(paths, grades) if not gd]
+    if missing:
+        raise LookupError(f"no scores of {', '.join(missing)} in {db}. Generate grades with --db first")
+    return grades
+
+
+def load_score_matrix(
+    paths: list[str], roster: Roster, reference: str = "grades.csv", jobs: int = 1, db: Optional[str] = None
+):
+    """
+    Load the grades of all tasks into a students x tasks matrix in roster order.
+    Args:
+        jobs: number of threads to read grade files with, it hides the latency of network shares
+        db: SQLite gradebook to read the grades from instead of the grade files
+    Returns:
+        (scores, submitted): float matrix with 0 for missing submissions and the boolean mask of submissions
+    """
+    import numpy as np  # only batch stats needs numpy, keep the other commands light
+
+    if db is not None:
+        grades = load_gradebook_scores(paths, db)
+    else:
+        check_references(paths, reference)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            # results are in the order of paths, the same as a serial load
+            grades = list(pool.map(lambda p: get_submission_stats(p, reference)[0], paths))
+
+    scores = np.zeros((len(roster), len(paths)))
+    submitted = np.zeros((len(roster), len(paths)), dtype=bool)
+    for col, gd in enumerate(grades):
+        rows = np.fromiter((roster.index.get(sid, -1) for sid in gd), dtype=np.int64, count=len(gd))
+        values = np.fromiter(gd.values(), dtype=float, count=len(gd))
+        known = rows >= 0  # submissions out of the roster are ignored
+        scores[rows[known], col] = values[known]
+        submitted[rows[known], col] = True
+    return scores, submitted
+
+
+def summarize_scores(scores, submitted, weights) -> dict:
+    """
+    Weighted means, ranks, percentiles, task averages and histogram of a score matrix.
+    Ranks are 1 + the number of students with a higher mean.
+    """
+    import numpy as np
+
+    means = scores @ weights
+    ordered = np.sort(means)
+    ranks = 1 + len(means) - np.searchsorted(ordered, means, side="right")
+    percentiles = np.searchsorted(ordered, means, side="right") / len(means) * 100
+    counts = submitted.sum(axis=0)
+    task_avg = np.divide(
+        np.where(submitted, scores, 0).sum(axis=0), counts,
+        out=np.full(scores.shape[1], np.nan), where=counts > 0,
+    )
+    # deciles from the lowest populated one, so a 60-100 run is not led by empty bins
+    low = int(np.floor(means.min() / 10)) * 10 if means.size else 0
+    edges = np.arange(min(low, 90), max(100, int(np.ceil(means.max(initial=0)))) + 10, 10)
+    hist, _ = np.histogram(means, bins=edges)
+    return {
+        "means": means,
+        "ranks": ranks,
+        "percentiles": percentiles,
+        "task_avg": task_avg,
+        "task_count": counts,
+        "hist": hist,
+        "edges": edges,
+    }
+
+
 def batch_stats(
     paths: list[str],
     weights: str = None,
     reference: str = "grades.csv",
-    roster: str = "names.csv",
+    roster: str | list[str] = "names.csv",
     storage: str = "billboard.csv",
+    jobs: int = 1,
+    db: Optional[str] = None,
 ):
+    """
+    Statistics of all tasks for the students of the roster(s).
+    Args:
+        paths: task directories with grade files
+        weights: comma separated weights of the tasks, default is equal weights
+        roster: roster file, or a list of roster files to aggregate several sections
+        jobs: number of threads to load grade files with
+        db: SQLite gradebook to read the grades from, the roster is saved into it
+    """
+    import numpy as np
+
     path_len = len(paths)
     if weights:
-        weight_list = [int(p) for p in weights.split(",")]
+        if isinstance(weights, str):
+            weights = weights.split(",")
+        weight_list = [int(p) for p in weights]
         assert len(paths) == len(
             weight_list
         ), f"paths and weigths should have the same length"
     else:
         weight_list = [1] * path_len
     # weight norm
-    weight_sum = sum(weight_list)
-    weight_list = [w / weight_sum for w in weight_list]
-
-    mapper = get_roster_dict(roster)
-    grades = {sid: [] for sid in mapper}
-    # data collection
-    for p in paths:
-        gd, _ = get_submission_stats(p, reference)
-        # merge grades and mapper
-        for sid in grades:
-            grades[sid].append(gd.get(sid, 0))
-
-    # write storage file
-    header = STAT_HEADER.format(stringify_list(range(1, len(paths)+1), ',')) + '\n'
-    mean_list = []
-    max_name, max_score = None, 0
-    min_name, min_score = None, 100
-    with open(storage, "w", encoding="utf-8-sig") as writer:  # for xlsx recognization
-        writer.write(header)
-        for k, v in grades.items():
-            mean = reduce(lambda acc, x: acc + x[0] * x[1], zip(v, weight_list), 0)
-            writer.write(f"{k},{mapper[k]},{stringify_list(v, ',')},{mean:.1f}\n")
-            # batch stats info
-            mean_list.append(mean)
-            if mean > max_score:
-                max_score = mean
-                max_name = mapper[k]
-            if mean < min_score:
-                min_score = mean
-                min_name = mapper[k]
-            print(f"{k},{mapper[k]}\t: {mean}")
-    print(f"avg: {sum(mean_list)/len(mean_list):.1f}")
-    print(f"max: {max_name}:{max_score:.1f}")
-    print(f"min: {min_name}:{min_score:.1f}")
+    weight_arr = np.asarray(weight_list, dtype=float)
+    weight_arr /= weight_arr.sum()
+
+    rosters = [roster] if isinstance(roster, str) else roster
+    mapper = merge_rosters([load_roster(r) for r in rosters])
+    assert len(mapper) > 0, "empty roster"
+    scores, submitted = load_score_matrix(paths, mapper, reference, jobs, db)
+    if db is not None:
+        from gradebook import Gradebook
+
+        with Gradebook(db) as gb:
+            gb.put_roster(mapper)
+    summary = summarize_scores(scores, submitted, weight_arr)
+    means = summary["means"]
+
+    # write storage file at once
+    header = STAT_HEADER.format(stringify_list(range(1, len(paths)+1), ','))
+    rows = [
+        (sid, name, *map("{:g}".format, row), f"{mean:.1f}", rank, f"{pct:.1f}")
+        for sid, name, row, mean, rank, pct in zip(
+            mapper.sids, mapper.names, scores, means, summary["ranks"], summary["percentiles"]
+        )
+    ]
+    with open(storage, "w", encoding="utf-8-sig", newline="") as writer:  # for xlsx recognization
+        writer.write(header + "\n")
+        csv.writer(writer, lineterminator="\n").writerows(rows)  # names with commas are quoted
+
+    # batch stats info
+    best, worst = int(np.argmax(means)), int(np.argmin(means))
+    print(f"avg: {means.mean():.1f}")
+    print(f"max: {mapper.names[best]}:{means[best]:.1f}")
+    print(f"min: {mapper.names[worst]}:{means[worst]:.1f}")
+    for i, (avg, cnt) in enumerate(zip(summary["task_avg"], summary["task_count"]), 1):
+        print(f"task {i}: avg {avg:.1f} of {cnt} submissions")
+    edges = summary["edges"]
+    for lo, hi, cnt in zip(edges[:-1], edges[1:], summary["hist"]):
+        print(f"[{lo}, {hi}{']' if hi == edges[-1] else ')'}: {cnt}")
 
 
 if __name__ == "__main__":
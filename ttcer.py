@@ -14,7 +14,7 @@ def get_ttc_fonts_map(ttc_file:str) -> dict[str, TTFont]:
     Returns:
         dict[str, TTFont]: font table. FullFontName: TTFont-object
     """
-    ttc = TTCollection(ttc_file)
+    ttc = TTCollection(ttc_file, lazy=True)  # tables are read on access, listing names reads only "name"
     return {font["name"].getDebugName(4): font for font in ttc.fonts}
 # DebugName ref: https://learn.microsoft.com/en-us/typography/opentype/spec/name#name-ids
 